@@ -0,0 +1,40 @@
+import os
+import sys
+import argparse
+import torch
+from benchmarks.cases import ALL_CASES
+from benchmarks.runner import compare, load_results, run_cases, save_results
+
+parser = argparse.ArgumentParser(description='Micro-benchmarks of the CIL hot paths on synthetic data (CPU).')
+
+parser.add_argument('--scale', type=str, default='small', choices=['small', 'full'], help='full goes up to 1000 classes')
+parser.add_argument('--filter', '-k', type=str, default=None, help='only run cases whose key contains this string')
+parser.add_argument('--repeats', type=int, default=5)
+parser.add_argument('--warmup', type=int, default=1)
+parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads, fix it for comparable numbers')
+parser.add_argument('--out', type=str, default='benchmark_results.json')
+parser.add_argument('--baseline', type=str, default='benchmarks/baseline.json', help='results json of a reference run to compare against')
+parser.add_argument('--update-baseline', action='store_true', help='also write the results to --baseline instead of comparing against it')
+parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown relative to the baseline')
+
+args = parser.parse_args()
+if args.threads is not None:
+    torch.set_num_threads(args.threads)
+
+results = run_cases(ALL_CASES, args.scale, args.repeats, args.warmup, args.filter)
+save_results(results, args.out, args.scale)
+print(f"Wrote {len(results)} results to {args.out}")
+
+if args.update_baseline:
+    save_results(results, args.baseline, args.scale)
+    print(f"Wrote {len(results)} results to {args.baseline}")
+elif not os.path.exists(args.baseline):
+    sys.exit(f"error: no baseline at {args.baseline}, run with --update-baseline to create it")
+else:
+    rows, regressions = compare(results, load_results(args.baseline), args.tolerance)
+    for key, base, current, ratio in rows:
+        flag = '  <== REGRESSION' if key in regressions else ''
+        print(f"{key:<70} {base:9.4f}s -> {current:9.4f}s  x{ratio:.2f}{flag}")
+    if regressions:
+        print(f"{len(regressions)} case(s) slower than {1 + args.tolerance:.2f}x the baseline")
+        sys.exit(1)
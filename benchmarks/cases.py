@@ -0,0 +1,324 @@
+"""
+Benchmark cases for the hot paths of the CIL pipeline, on synthetic data.
+
+Every case function takes the scale ("small" or "full") and yields
+(name, params, fn): the setup runs while yielding, and only fn() is timed.
+"""
+import numpy as np
+import torch
+from torch import nn
+from unittest import mock
+
+# Per-dataset shapes of the synthetic data
+SHAPES = {
+    "cifar": dict(
+        train_per_class=500,
+        test_per_class=100,
+        feature_dim=64,
+        image_shape=(32, 32, 3),
+        convnet_type="resnet32",
+        fmap_shapes=[(16, 32, 32), (32, 16, 16), (64, 8, 8)],
+        batch_size=128,
+    ),
+    "imagenet": dict(
+        train_per_class=1300,
+        test_per_class=50,
+        feature_dim=512,
+        image_shape=(224, 224, 3),
+        convnet_type="resnet18",
+        fmap_shapes=[(64, 56, 56), (128, 28, 28), (256, 14, 14), (512, 7, 7)],
+        batch_size=32,
+    ),
+}
+NB_CLASSES = {"small": [10, 100], "full": [10, 100, 1000]}
+NB_BACKBONES = {"small": [1, 5], "full": [1, 5, 10, 20]}
+memory_per_class = 20
+increment = 10
+
+
+def herding_cases(scale):
+    from utils.herding import herding_batch
+
+    for dataset, shape in SHAPES.items():
+        for nb_classes in NB_CLASSES[scale]:
+            rng = np.random.RandomState(0)
+            class_vectors = [
+                _normalize(
+                    rng.randn(shape["train_per_class"], shape["feature_dim"]).astype(
+                        np.float32
+                    )
+                )
+                for _ in range(nb_classes)
+            ]
+            params = dict(dataset=dataset, nb_classes=nb_classes, m=memory_per_class)
+            yield "herding", params, lambda cv=class_vectors: herding_batch(
+                cv, memory_per_class
+            )
+
+
+def construct_exemplar_cases(scale):
+    """
+    BaseLearner._construct_exemplar for a task of `increment` new classes:
+    feature extraction, herding, the memory update and the class means.
+    """
+    from models.base import BaseLearner
+    from utils.exemplar_memory import ExemplarMemory
+
+    shape = SHAPES["cifar"]
+    for nb_classes in NB_CLASSES[scale]:
+        if nb_classes == 1000:
+            continue  # See get_dataset_cases
+        data_manager = _synthetic_data_manager("cifar", nb_classes)
+        learner = BaseLearner(
+            dict(memory_size=nb_classes * memory_per_class, device=[torch.device("cpu")])
+        )
+        torch.manual_seed(0)
+        learner._network = _PooledNet(shape["feature_dim"])
+        learner._known_classes = nb_classes - increment
+        learner._total_classes = nb_classes
+
+        def fn(learner=learner, data_manager=data_manager):
+            learner._feature_cache.reset()
+            learner._memory = ExemplarMemory(learner._memory_size)
+            learner._class_means = np.zeros((nb_classes, learner.feature_dim))
+            learner._construct_exemplar(data_manager, memory_per_class)
+
+        params = dict(dataset="cifar", nb_classes=nb_classes, m=memory_per_class)
+        yield "construct_exemplar", params, fn
+
+
+def eval_nme_cases(scale):
+    from models.base import BaseLearner
+
+    for dataset, shape in SHAPES.items():
+        for nb_classes in NB_CLASSES[scale]:
+            rng = np.random.RandomState(0)
+            n = nb_classes * shape["test_per_class"]
+            vectors = torch.from_numpy(
+                rng.randn(n, shape["feature_dim"]).astype(np.float32)
+            )
+            targets = torch.from_numpy(rng.randint(0, nb_classes, n))
+            loader = [
+                (None, vectors[i : i + 128], targets[i : i + 128])
+                for i in range(0, n, 128)
+            ]
+            class_means = _normalize(
+                rng.randn(nb_classes, shape["feature_dim"]).astype(np.float32)
+            )
+            learner = BaseLearner(dict(memory_size=0, device=[torch.device("cpu")]))
+            learner._network = _FeatureNet()
+
+            params = dict(dataset=dataset, nb_classes=nb_classes, nb_test=n)
+            yield "eval_nme", params, lambda l=learner, ld=loader, cm=class_means: l._eval_nme(
+                ld, cm
+            )
+
+
+def get_dataset_cases(scale):
+    for dataset, shape in SHAPES.items():
+        for nb_classes in NB_CLASSES[scale]:
+            if dataset == "cifar" and nb_classes == 1000:
+                continue  # 1.5GB of synthetic pixels, not representative of any setting
+            data_manager = _synthetic_data_manager(dataset, nb_classes)
+            known = nb_classes - increment
+            memory_positions = [np.array([], dtype=np.int64)] + [
+                data_manager.get_positions([c], "train")[:memory_per_class]
+                for c in range(known)
+            ]
+            memory = data_manager.get_data(np.concatenate(memory_positions), "train")
+            params = dict(dataset=dataset, nb_classes=nb_classes)
+            yield "get_dataset", params, lambda dm=data_manager, k=known, mem=memory: dm.get_dataset(
+                np.arange(k, k + increment), source="train", mode="train", appendent=mem
+            )
+
+
+def dataset_iter_cases(scale):
+    """One pass of train-mode loading over CIFAR-shaped in-memory data."""
+    from torch.utils.data import DataLoader
+
+    nb_samples = 2048 if scale == "small" else 10240
+    for batch_aug in [False, True]:
+        data_manager = _synthetic_data_manager(
+            "cifar", nb_samples // SHAPES["cifar"]["train_per_class"], batch_aug
+        )
+        dataset = data_manager.get_dataset(
+            np.arange(data_manager.get_total_classnum()), source="train", mode="train"
+        )
+        loader = DataLoader(dataset, batch_size=128, shuffle=True, num_workers=0)
+        params = dict(dataset="cifar", nb_samples=nb_samples, batch_aug=batch_aug)
+        yield "dataset_iter", params, lambda ld=loader: [batch for batch in ld]
+
+
+def gem_projection_cases(scale):
+    from models.gem import project2cone
+
+    nb_params = _nb_params(SHAPES["cifar"]["convnet_type"])
+    for nb_old_tasks in [1, 4, 9] if scale == "small" else [1, 4, 9, 19]:
+        torch.manual_seed(0)
+        old_grad = torch.randn(nb_old_tasks, nb_params)
+        cur_grad = -old_grad.mean(dim=0) + 0.1 * torch.randn(nb_params)
+        params = dict(nb_params=nb_params, nb_old_tasks=nb_old_tasks)
+        yield "gem_projection", params, lambda o=old_grad, c=cur_grad: project2cone(o, c)
+
+
+def pod_spatial_loss_cases(scale):
+    from models.podnet import pod_spatial_loss
+
+    for dataset, shape in SHAPES.items():
+        torch.manual_seed(0)
+        bs = shape["batch_size"]
+        old_fmaps = [torch.rand(bs, *s) for s in shape["fmap_shapes"]]
+        fmaps = [torch.rand(bs, *s, requires_grad=True) for s in shape["fmap_shapes"]]
+
+        def fn(old_fmaps=old_fmaps, fmaps=fmaps):
+            pod_spatial_loss(old_fmaps, fmaps).backward()
+
+        yield "pod_spatial_loss", dict(dataset=dataset, batch_size=bs), fn
+
+
+def lsc_nca_cases(scale):
+    from convs.linears import CosineLinear
+    from models.podnet import lsc_nca, nb_proxy
+
+    feature_dim = SHAPES["imagenet"]["feature_dim"]
+    bs = SHAPES["cifar"]["batch_size"]
+    for nb_classes in [100, 1000]:
+        torch.manual_seed(0)
+        fc = CosineLinear(feature_dim, nb_classes, nb_proxy, to_reduce=True)
+        features = torch.randn(bs, feature_dim, requires_grad=True)
+        targets = torch.randint(nb_classes, (bs,))
+
+        def fn(fc=fc, features=features, targets=targets):
+            proxy_logits = fc(features)["proxy_logits"]
+            lsc_nca(proxy_logits, fc.sigma, targets, nb_proxy).backward()
+
+        params = dict(nb_classes=nb_classes, nb_proxy=nb_proxy, batch_size=bs)
+        yield "lsc_nca", params, fn
+
+
+def coil_sinkhorn_cases(scale):
+    from utils.sinkhorn import sinkhorn
+
+    for nb_classes in NB_CLASSES[scale]:
+        rng = np.random.RandomState(0)
+        feature_dim = SHAPES["cifar"]["feature_dim"]
+        old_means = torch.from_numpy(_normalize(rng.randn(nb_classes, feature_dim)))
+        new_means = torch.from_numpy(_normalize(rng.randn(increment, feature_dim)))
+        cost = torch.cdist(old_means, new_means, p=3.0)  # norm_term of exps/coil.json
+        mu1 = torch.ones(len(old_means)) / len(old_means)
+        mu2 = torch.ones(len(new_means)) / len(old_means)
+        params = dict(nb_classes=nb_classes)
+        yield "coil_sinkhorn", params, lambda a=mu1, b=mu2, M=cost: sinkhorn(
+            a, b, M, 0.464
+        )
+
+
+def dernet_forward_cases(scale):
+    from utils.inc_net import DERNet
+
+    for dataset, shape in SHAPES.items():
+        if dataset == "imagenet" and scale != "full":
+            continue
+        torch.manual_seed(0)
+        network = DERNet(shape["convnet_type"], False)
+        h, w, c = shape["image_shape"]
+        inputs = torch.rand(shape["batch_size"], c, h, w)
+        for nb_backbones in NB_BACKBONES[scale]:
+            while len(network.convnets) < nb_backbones:
+                network.update_fc((len(network.convnets) + 1) * increment)
+            network.eval()
+
+            def fn(network=network, inputs=inputs):
+                with torch.no_grad():
+                    network(inputs)
+
+            params = dict(dataset=dataset, nb_backbones=nb_backbones)
+            yield "dernet_forward", params, fn
+
+
+ALL_CASES = [
+    herding_cases,
+    construct_exemplar_cases,
+    eval_nme_cases,
+    get_dataset_cases,
+    dataset_iter_cases,
+    gem_projection_cases,
+    pod_spatial_loss_cases,
+    lsc_nca_cases,
+    coil_sinkhorn_cases,
+    dernet_forward_cases,
+]
+
+
+class _FeatureNet(nn.Module):
+    """Stands in for a backbone: the "inputs" already are the features."""
+
+    def extract_vector(self, x):
+        return x
+
+
+class _PooledNet(nn.Module):
+    """Cheap stand-in for a backbone on images: pooled pixels and a projection."""
+
+    def __init__(self, feature_dim):
+        super().__init__()
+        self.feature_dim = feature_dim
+        self.fc = nn.Linear(3 * 4 * 4, feature_dim)
+
+    def extract_vector(self, x):
+        return self.fc(nn.functional.adaptive_avg_pool2d(x, 4).flatten(1))
+
+
+def _normalize(vectors):
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _nb_params(convnet_type):
+    from utils.inc_net import get_convnet
+
+    return sum(p.numel() for p in get_convnet(convnet_type).parameters())
+
+
+def _synthetic_data_manager(dataset, nb_classes, batch_aug=False):
+    from utils import data_manager
+    from utils.data import iCIFAR100, iImageNet100
+
+    shape = SHAPES[dataset]
+    base = iCIFAR100 if dataset == "cifar" else iImageNet100
+
+    class Synthetic(base):
+        class_order = list(range(nb_classes))
+
+        def download_data(self):
+            rng = np.random.RandomState(0)
+            n_train = nb_classes * shape["train_per_class"]
+            n_test = nb_classes * shape["test_per_class"]
+            if self.use_path:
+                # Never decoded by these cases
+                self.train_data = np.array(
+                    ["train/{}.JPEG".format(i) for i in range(n_train)]
+                )
+                self.test_data = np.array(["val/{}.JPEG".format(i) for i in range(n_test)])
+            else:
+                self.train_data = rng.randint(
+                    0, 256, (n_train, *shape["image_shape"]), dtype=np.uint8
+                )
+                self.test_data = rng.randint(
+                    0, 256, (n_test, *shape["image_shape"]), dtype=np.uint8
+                )
+            self.train_targets = rng.permutation(
+                np.repeat(np.arange(nb_classes), shape["train_per_class"])
+            )
+            self.test_targets = rng.permutation(
+                np.repeat(np.arange(nb_classes), shape["test_per_class"])
+            )
+
+    with mock.patch.object(data_manager, "_get_idata", lambda _: Synthetic()):
+        return data_manager.DataManager(
+            dataset,
+            False,
+            1993,
+            min(increment, nb_classes),
+            increment,
+            batch_aug=batch_aug,
+        )
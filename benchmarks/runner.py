@@ -0,0 +1,97 @@
+import json
+import platform
+import time
+import warnings
+import numpy as np
+import torch
+
+
+def case_key(name, params):
+    return "{}[{}]".format(name, ",".join("{}={}".format(k, v) for k, v in params.items()))
+
+
+def run_cases(case_fns, scale="small", repeats=5, warmup=1, pattern=None):
+    results = {}
+    warnings.simplefilter("ignore", UserWarning)  # Deprecation/convergence noise
+    for case_fn in case_fns:
+        for name, params, fn in case_fn(scale):
+            key = case_key(name, params)
+            if pattern is not None and pattern not in key:
+                continue
+            for _ in range(warmup):
+                fn()
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                fn()
+                times.append(time.perf_counter() - start)
+            results[key] = {
+                "name": name,
+                "params": params,
+                "median": float(np.median(times)),
+                "min": float(np.min(times)),
+                "times": times,
+                "saved_bytes": saved_tensor_bytes(fn),
+            }
+            line = "{}: {:.4f}s".format(key, results[key]["median"])
+            if results[key]["saved_bytes"] > 0:
+                line += ", {:.1f} MiB saved for backward".format(
+                    results[key]["saved_bytes"] / 2 ** 20
+                )
+            print(line, flush=True)
+
+    return results
+
+
+def saved_tensor_bytes(fn):
+    """Size of the distinct storages that autograd keeps for backward during fn()."""
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(storages.values())
+
+
+def save_results(results, path, scale):
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "scale": scale,
+            "torch": torch.__version__,
+            "numpy": np.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "threads": torch.get_num_threads(),
+        },
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Returns the rows (key, baseline median, median, ratio) of the cases present
+    in both, and the keys of those that got slower than (1 + tolerance) x baseline.
+    """
+    rows, regressions = [], []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        ratio = result["median"] / baseline[key]["median"]
+        rows.append((key, baseline[key]["median"], result["median"], ratio))
+        if ratio > 1 + tolerance:
+            regressions.append(key)
+
+    return rows, regressions
@@ -0,0 +1,19 @@
+import argparse
+from torchvision import datasets
+from utils.shard import write_shard
+
+parser = argparse.ArgumentParser(description='Convert an ImageFolder dataset into a pre-decoded, memory-mapped shard.')
+
+parser.add_argument('--data_path', type=str, required=True, help='folder containing train/ and val/')
+parser.add_argument('--out', type=str, required=True, help='shard prefix, e.g. ./data/shards/imagenet100')
+parser.add_argument('--short_side', type=int, default=256)
+parser.add_argument('--num_workers', type=int, default=8)
+
+args = parser.parse_args()
+
+splits = {
+    split: datasets.ImageFolder(f"{args.data_path}/{split}/").imgs
+    for split in ['train', 'val']
+}
+write_shard(splits, args.out, short_side=args.short_side, num_workers=args.num_workers)
+print(f"Wrote {sum(len(s) for s in splits.values())} images to {args.out}.bin")
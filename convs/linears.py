@@ -6,6 +6,7 @@ import math
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.autograd.function import once_differentiable
 
 
 class SimpleLinear(nn.Module):
@@ -54,15 +55,19 @@ class CosineLinear(nn.Module):
 
     def forward(self, input):
         out = F.linear(F.normalize(input, p=2, dim=1), F.normalize(self.weight, p=2, dim=1))
+        if not self.to_reduce:
+            if self.sigma is not None:
+                out = self.sigma * out
+            return {'logits': out}
 
-        if self.to_reduce:
-            # Reduce_proxy
-            out = reduce_proxies(out, self.nb_proxy)
+        # Reduce_proxy; the proxy similarities are kept for losses fused with it
+        proxy_out = out
+        out = reduce_proxies(out, self.nb_proxy)
 
         if self.sigma is not None:
             out = self.sigma * out
 
-        return {'logits': out}
+        return {'logits': out, 'proxy_logits': proxy_out}
 
 
 class SplitCosineLinear(nn.Module):
@@ -83,18 +88,19 @@ class SplitCosineLinear(nn.Module):
         out1 = self.fc1(x)
         out2 = self.fc2(x)
 
-        out = torch.cat((out1['logits'], out2['logits']), dim=1)  # concatenate along the channel
-
-        # Reduce_proxy
-        out = reduce_proxies(out, self.nb_proxy)
+        # Reduce_proxy, class by class, so the two parts can be reduced on their own
+        old_scores = reduce_proxies(out1['logits'], self.nb_proxy)
+        new_scores = reduce_proxies(out2['logits'], self.nb_proxy)
+        out = torch.cat((old_scores, new_scores), dim=1)  # concatenate along the channel
 
         if self.sigma is not None:
             out = self.sigma * out
 
         return {
-            'old_scores': reduce_proxies(out1['logits'], self.nb_proxy),
-            'new_scores': reduce_proxies(out2['logits'], self.nb_proxy),
-            'logits': out
+            'old_scores': old_scores,
+            'new_scores': new_scores,
+            'logits': out,
+            'proxy_logits': torch.cat((out1['logits'], out2['logits']), dim=1)
         }
 
 
@@ -107,9 +113,42 @@ def reduce_proxies(out, nb_proxy):
     nb_classes = int(nb_classes)
 
     simi_per_class = out.view(bs, nb_classes, nb_proxy)
-    attentions = F.softmax(simi_per_class, dim=-1)
 
-    return (attentions * simi_per_class).sum(-1)
+    return _ReduceProxies.apply(simi_per_class)
+
+
+class _ReduceProxies(torch.autograd.Function):
+    '''
+    sum_k softmax(s)_k * s_k over the proxies k of each class, without
+    materializing the attentions: exp(s - max) is normalized through its sum,
+    and recomputed in backward, where d/ds_k = softmax(s)_k * (1 + s_k - out).
+    Only s and per-class vectors are kept for backward.
+    '''
+
+    @staticmethod
+    def forward(ctx, simi_per_class):
+        simi = _upcast(simi_per_class)
+        shift = simi.amax(dim=-1, keepdim=True)
+        exps = (simi - shift).exp_()
+        norm = exps.sum(-1)
+        out = (exps * simi).sum(-1) / norm
+        ctx.save_for_backward(simi_per_class, shift, norm, out)
+        return out.to(simi_per_class.dtype)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        simi_per_class, shift, norm, out = ctx.saved_tensors
+        simi = _upcast(simi_per_class)
+        grad = (simi - shift).exp_()
+        grad.mul_((grad_output.to(norm.dtype) / norm).unsqueeze(-1))
+        grad.mul_(simi - (out - 1).unsqueeze(-1))
+        return grad.to(simi_per_class.dtype)
+
+
+def _upcast(x):
+    # Half precision similarities are reduced in float32
+    return x.to(torch.promote_types(x.dtype, torch.float32))
 
 
 '''
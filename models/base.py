@@ -3,12 +3,20 @@ import logging
 import numpy as np
 import torch
 from torch import nn
-from torch.utils.data import DataLoader
 from utils.toolkit import tensor2numpy, accuracy
-from scipy.spatial.distance import cdist
+from utils.herding import herding_batch
+from utils.feature_cache import FeatureCache
+from utils.exemplar_memory import ExemplarMemory
+from utils.loader_factory import LoaderFactory
+from utils.async_eval import AsyncEvaluator
+from utils.teacher_cache import ReplayDataset, ReplaySampler, TeacherCache
+from utils.class_stats import ClassFeatureStats
 import os
 
 EPSILON = 1e-8
+nme_chunk_size = 8192
+aug_replays = 4
+teacher_cache_bytes = 8 * 2 ** 30
 batch_size = 64
 
 
@@ -20,10 +28,32 @@ class BaseLearner(object):
         self._total_classes = 0
         self._network = None
         self._old_network = None
-        self._data_memory, self._targets_memory = np.array([]), np.array([])
+        self._feature_cache = FeatureCache()
+        self._loaders = LoaderFactory(args)
+        self._teacher_cache = None
         self.topk = 5
 
+        # None, "train" or "eval", see _update_class_stats
+        self._class_stats_mode = args.get("class_stats", None)
+        if self._class_stats_mode not in (None, "train", "eval"):
+            raise ValueError("Unknown class_stats {}".format(self._class_stats_mode))
+        self._class_stats = None
+        self._class_stats_task = None
+
+        # "fp32" or "bf16" (autocast), see _forward
+        self._autocast_dtype = _get_autocast_dtype(args.get("precision", "fp32"))
+        self._channels_last = args.get("channels_last", False)
+
+        # None keeps the cadence of each training loop, see _compute_epoch_accuracy
+        self._eval_every = args.get("eval_every", None)
+        self._async_eval = None
+        if args.get("async_eval", False):
+            self._async_eval = AsyncEvaluator(
+                args.get("async_eval_device", "cpu"), batch_size
+            )
+
         self._memory_size = args["memory_size"]
+        self._memory = ExemplarMemory(self._memory_size)
         self._memory_per_class = args.get("memory_per_class", None)
         self._fixed_memory = args.get("fixed_memory", False)
         self._device = args["device"][0]
@@ -31,10 +61,7 @@ class BaseLearner(object):
 
     @property
     def exemplar_size(self):
-        assert len(self._data_memory) == len(
-            self._targets_memory
-        ), "Exemplar size error."
-        return len(self._targets_memory)
+        return len(self._memory)
 
     @property
     def samples_per_class(self):
@@ -76,6 +103,12 @@ class BaseLearner(object):
     def after_task(self):
         pass
 
+    def close(self):
+        """End of the run: shuts down the background evaluator, if any."""
+        if self._async_eval is not None:
+            self._async_eval.wait()
+            self._async_eval.close()
+
     def _evaluate(self, y_pred, y_true):
         ret = {}
         grouped = accuracy(y_pred.T[0], y_true, self._known_classes)
@@ -89,13 +122,17 @@ class BaseLearner(object):
         return ret
 
     def eval_task(self, save_conf=False):
-        y_pred, y_true = self._eval_cnn(self.test_loader)
-        cnn_accy = self._evaluate(y_pred, y_true)
-
+        if self._async_eval is not None:
+            self._async_eval.wait()
         if hasattr(self, "_class_means"):
-            y_pred, y_true = self._eval_nme(self.test_loader, self._class_means)
+            # One pass over the test set for both classifiers
+            y_pred, y_true, vectors = self._eval_cnn(self.test_loader, ret_vectors=True)
+            cnn_accy = self._evaluate(y_pred, y_true)
+            y_pred = self._nme_predict(vectors, self._class_means)
             nme_accy = self._evaluate(y_pred, y_true)
         else:
+            y_pred, y_true = self._eval_cnn(self.test_loader)
+            cnn_accy = self._evaluate(y_pred, y_true)
             nme_accy = None
         
         if save_conf:
@@ -120,10 +157,7 @@ class BaseLearner(object):
         pass
 
     def _get_memory(self):
-        if len(self._data_memory) == 0:
-            return None
-        else:
-            return (self._data_memory, self._targets_memory)
+        return self._memory.get_memory()
 
     def _compute_accuracy(self, model, loader):
         model.eval()
@@ -131,20 +165,171 @@ class BaseLearner(object):
         for i, (_, inputs, targets) in enumerate(loader):
             inputs = inputs.to(self._device)
             with torch.no_grad():
-                outputs = model(inputs)["logits"]
+                outputs = self._forward(model, inputs)["logits"]
             predicts = torch.max(outputs, dim=1)[1]
             correct += (predicts.cpu() == targets).sum()
             total += len(targets)
 
         return np.around(tensor2numpy(correct) * 100 / total, decimals=2)
 
-    def _eval_cnn(self, loader):
+    def _forward(self, fn, inputs):
+        """
+        fn(inputs) for a network (or one of its methods such as extract_vector),
+        in the "precision" and memory format of the run. Floating point outputs
+        come back in float32, so losses (KD, NCA, ...) are computed on them in
+        full precision.
+        """
+        if self._channels_last and inputs.dim() == 4:
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+        if self._autocast_dtype is None:
+            return fn(inputs)
+        with torch.autocast(inputs.device.type, dtype=self._autocast_dtype):
+            outputs = fn(inputs)
+        return _to_float(outputs)
+
+    def _get_train_loader(
+        self,
+        dataset,
+        batch_size,
+        num_workers,
+        fields=("logits",),
+        pin_memory=None,
+        name="train",
+    ):
+        """
+        The shuffled `name` loader. With "teacher_cache" and an old network to
+        distill from, the samples cycle through "aug_replays" fixed augmentations,
+        and _teacher_forward() computes the `fields` of the old network for each
+        (sample, augmentation) only once. The cache files may take at most
+        "teacher_cache_bytes" of disk.
+        """
+        self._teacher_cache = None
+        sampler = None
+        if self.args.get("teacher_cache", False) and self._old_network is not None:
+            nb_replays = self.args.get("aug_replays", aug_replays)
+            seed = int(torch.randint(2 ** 31, ()).item())
+            dataset = ReplayDataset(dataset, nb_replays, seed)
+            sampler = ReplaySampler(len(dataset), nb_replays)
+            self._teacher_cache = TeacherCache(
+                len(dataset) * nb_replays,
+                fields,
+                self.args.get("teacher_cache_dir"),
+                self.args.get("teacher_cache_bytes", teacher_cache_bytes),
+            )
+
+        return self._loaders.get_loader(
+            name,
+            dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            sampler=sampler,
+        )
+
+    def _teacher_forward(self, keys, inputs):
+        """Outputs of the old network on `inputs`, the batch `keys` of the train loader."""
+        if self._teacher_cache is None:
+            return self._forward(self._old_network, inputs)
+        return self._teacher_cache(
+            keys, inputs, lambda x: self._forward(self._old_network, x)
+        )
+
+    def _update_class_stats(self, epoch, epochs, inputs, targets, features):
+        """
+        Training loop hook: during the last epoch, accumulates per-class sums of
+        the normalized features of the batch, from which _reduce_exemplar and
+        _construct_exemplar take the NME class means instead of extracting them.
+        With "class_stats": "train" these are the features of the training
+        forward; with "eval", eval-mode features averaged with those of the
+        mirrored inputs, at the cost of one extra forward per step of the last
+        epoch. That only removes the random flip and the batch statistics: the
+        inputs still carry the random crop and colour jitter of the training
+        batch, so these are not the features of the test-mode transform.
+        """
+        if self._class_stats_mode is None or epoch != epochs - 1:
+            return
+        if self._class_stats_task != self._cur_task:
+            self._class_stats = ClassFeatureStats(
+                self._total_classes, self.feature_dim, self._device
+            )
+            self._class_stats_task = self._cur_task
+
+        self._class_stats.update(self._class_stats_vectors(inputs, features), targets)
+
+    def _class_stats_vectors(self, inputs, features):
+        if self._class_stats_mode == "eval":
+            modes = [module.training for module in self._network.modules()]
+            self._network.eval()
+            with torch.no_grad():
+                vectors = self._get_vectors(torch.cat([inputs, inputs.flip(-1)]))
+            for module, mode in zip(self._network.modules(), modes):
+                module.training = mode
+        else:
+            vectors = features.detach()
+        vectors = vectors.float()
+        vectors = vectors / (vectors.norm(dim=1, keepdim=True) + EPSILON)
+        if self._class_stats_mode == "eval":
+            vectors = (vectors[: len(inputs)] + vectors[len(inputs) :]) / 2
+        return vectors
+
+    def _stats_class_means(self, classes):
+        """
+        NME means of `classes` from the statistics of this task's training, or
+        None if they are off or miss one of the classes.
+        """
+        if self._class_stats is None or self._class_stats_task != self._cur_task:
+            return None
+        classes = torch.as_tensor(classes, device=self._device)
+        if (self._class_stats.counts[classes] == 0).any():
+            return None
+        means = self._class_stats.means()[classes]
+        return tensor2numpy(means / means.norm(dim=1, keepdim=True))
+
+    def _compute_epoch_accuracy(
+        self, model, loader, epoch, epochs, every=5, skip_every=False
+    ):
+        """
+        Test accuracy at the end of a training epoch (counted from 0), or None
+        when the cadence skips it. The loop's own cadence is every `every` epochs,
+        or with `skip_every` all epochs but those. "eval_every" overrides it with
+        N (every N epochs), "final" or "none". With "async_eval", a snapshot of
+        the model is evaluated in the background instead and None is returned.
+        """
+        if self._eval_every is not None:
+            every, skip_every = self._eval_every, False
+        if every == "final":
+            due = epoch == epochs - 1
+        elif every in (0, "none"):
+            due = False
+        else:
+            due = (epoch % int(every) == 0) != skip_every
+        if not due:
+            return None
+
+        if self._async_eval is not None:
+            tag = "Task {}, Epoch {}/{}".format(self._cur_task, epoch + 1, epochs)
+            self._async_eval.submit(tag, model, loader)
+            return None
+        return self._compute_accuracy(model, loader)
+
+    def _eval_cnn(self, loader, ret_vectors=False):
+        """
+        Top-k predictions of the classifier. With ret_vectors, also returns the
+        features of the same forward pass, as extract_vector() would give them.
+        """
         self._network.eval()
-        y_pred, y_true = [], []
+        y_pred, y_true, vectors = [], [], []
         for _, (_, inputs, targets) in enumerate(loader):
             inputs = inputs.to(self._device)
             with torch.no_grad():
-                outputs = self._network(inputs)["logits"]
+                outputs = self._forward(self._network, inputs)
+                if ret_vectors:
+                    if "features" in outputs:
+                        vectors.append(tensor2numpy(outputs["features"]))
+                    else:
+                        vectors.append(tensor2numpy(self._get_vectors(inputs)))
+                outputs = outputs["logits"]
             predicts = torch.topk(
                 outputs, k=self.topk, dim=1, largest=True, sorted=True
             )[
@@ -153,242 +338,221 @@ class BaseLearner(object):
             y_pred.append(predicts.cpu().numpy())
             y_true.append(targets.cpu().numpy())
 
+        if ret_vectors:
+            return np.concatenate(y_pred), np.concatenate(y_true), np.concatenate(vectors)
         return np.concatenate(y_pred), np.concatenate(y_true)  # [N, topk]
 
     def _eval_nme(self, loader, class_means):
         self._network.eval()
         vectors, y_true = self._extract_vectors(loader)
-        vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
 
-        dists = cdist(class_means, vectors, "sqeuclidean")  # [nb_classes, N]
-        scores = dists.T  # [N, nb_classes], choose the one with the smallest distance
-
-        return np.argsort(scores, axis=1)[:, : self.topk], y_true  # [N, topk]
+        return self._nme_predict(vectors, class_means), y_true
+
+    def _nme_predict(self, vectors, class_means):
+        """
+        Top-k nearest class means. ||m - v||^2 = ||m||^2 - 2 m.v + ||v||^2, so the
+        ranking is that of 2 m.v - ||m||^2: a float32 GEMM and a top-k on the
+        device, chunk by chunk, instead of a float64 cdist and a full argsort.
+        """
+        means = torch.from_numpy(np.asarray(class_means)).float().to(self._device)
+        means_sq = (means ** 2).sum(dim=1)
+        topk = min(self.topk, len(means))
+
+        y_pred = []
+        for start in range(0, len(vectors), nme_chunk_size):
+            _vectors = torch.from_numpy(vectors[start : start + nme_chunk_size])
+            _vectors = _vectors.float().to(self._device)
+            _vectors = _vectors / (torch.norm(_vectors, dim=1, keepdim=True) + EPSILON)
+            scores = torch.addmm(means_sq, _vectors, means.T, beta=-1, alpha=2)
+            y_pred.append(torch.topk(scores, k=topk, dim=1)[1].cpu().numpy())
+
+        if len(y_pred) == 0:
+            return np.zeros((0, topk), dtype=np.int64)
+        return np.concatenate(y_pred)  # [N, topk]
+
+    def _get_vectors(self, inputs):
+        if isinstance(self._network, nn.DataParallel):
+            return self._forward(self._network.module.extract_vector, inputs)
+        return self._forward(self._network.extract_vector, inputs)
 
     def _extract_vectors(self, loader):
         self._network.eval()
         vectors, targets = [], []
         for _, _inputs, _targets in loader:
             _targets = _targets.numpy()
-            if isinstance(self._network, nn.DataParallel):
-                _vectors = tensor2numpy(
-                    self._network.module.extract_vector(_inputs.to(self._device))
-                )
-            else:
-                _vectors = tensor2numpy(
-                    self._network.extract_vector(_inputs.to(self._device))
-                )
+            _vectors = tensor2numpy(self._get_vectors(_inputs.to(self._device)))
 
             vectors.append(_vectors)
             targets.append(_targets)
 
         return np.concatenate(vectors), np.concatenate(targets)
 
-    def _reduce_exemplar(self, data_manager, m):
-        logging.info("Reducing exemplars...({} per classes)".format(m))
-        dummy_data, dummy_targets = copy.deepcopy(self._data_memory), copy.deepcopy(
-            self._targets_memory
-        )
-        self._class_means = np.zeros((self._total_classes, self.feature_dim))
-        self._data_memory, self._targets_memory = np.array([]), np.array([])
-
-        for class_idx in range(self._known_classes):
-            mask = np.where(dummy_targets == class_idx)[0]
-            dd, dt = dummy_data[mask][:m], dummy_targets[mask][:m]
-            self._data_memory = (
-                np.concatenate((self._data_memory, dd))
-                if len(self._data_memory) != 0
-                else dd
+    def _extract_cached_vectors(self, data_manager, positions, source="train"):
+        """
+        Features of the samples at `positions` of the `source` split (test mode),
+        only running the network on the ones not in the feature cache yet.
+        """
+        if len(positions) == 0:
+            return np.zeros((0, self.feature_dim), dtype=np.float32)
+        vectors, hit = self._feature_cache.lookup(positions, source)
+        if not hit.all():
+            missing = positions[~hit]
+            in_memory = None
+            if source == "train":
+                in_memory = np.isin(missing, self._memory.positions)
+            missing_dset = data_manager.get_dataset_by_positions(
+                missing, source=source, mode="test", cached=in_memory
             )
-            self._targets_memory = (
-                np.concatenate((self._targets_memory, dt))
-                if len(self._targets_memory) != 0
-                else dt
+            missing_loader = self._loaders.get_loader(
+                "features",
+                missing_dset,
+                batch_size=batch_size,
+                shuffle=False,
+                num_workers=4,
             )
+            missing_vectors, _ = self._extract_vectors(missing_loader)
+            self._feature_cache.update(missing, missing_vectors, source)
+            vectors, _ = self._feature_cache.lookup(positions, source)
+
+        return vectors
+
+    def _herding(self, class_vectors, ms):
+        device = self._device if self.args.get("herding_on_device", False) else None
+        return herding_batch(class_vectors, ms, device=device)
+
+    def _compute_class_means(self, vectors, targets):
+        """
+        Normalized per-class means of the L2-normalized `vectors`, grouped by
+        `targets` with a single reduceat instead of one pass per class.
+        Returns (classes, means).
+        """
+        vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
+        order = np.argsort(targets, kind="stable")
+        classes, starts, counts = np.unique(
+            targets[order], return_index=True, return_counts=True
+        )
+        means = np.add.reduceat(vectors[order], starts, axis=0)
+        means = means / counts[:, None].astype(means.dtype)
+        means = means / np.linalg.norm(means, axis=1, keepdims=True)
+
+        return classes.astype(np.int64), means
+
+    def _select_new_exemplars(self, data_manager, ms):
+        """
+        Herding over all new classes from one extraction pass.
+        Returns the train positions and targets of the selected exemplars.
+        """
+        class_positions = [
+            data_manager.get_positions([class_idx], source="train")
+            for class_idx in range(self._known_classes, self._total_classes)
+        ]
+        vectors = self._extract_cached_vectors(
+            data_manager, np.concatenate(class_positions)
+        )
+        vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
+        class_vectors = np.split(
+            vectors, np.cumsum([len(positions) for positions in class_positions])[:-1]
+        )
 
-            # Exemplar mean
-            idx_dataset = data_manager.get_dataset(
-                [], source="train", mode="test", appendent=(dd, dt)
-            )
-            idx_loader = DataLoader(
-                idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4
+        # Select
+        selections = self._herding(class_vectors, ms)
+
+        selected = np.concatenate(
+            [
+                positions[selection]
+                for positions, selection in zip(class_positions, selections)
+            ]
+        )
+        targets = np.repeat(
+            np.arange(self._known_classes, self._total_classes),
+            [len(selection) for selection in selections],
+        )
+
+        return selected, targets
+
+    def _reduce_exemplar(self, data_manager, m):
+        logging.info("Reducing exemplars...({} per classes)".format(m))
+        self._feature_cache.reset()
+        self._class_means = np.zeros((self._total_classes, self.feature_dim))
+        self._memory.reduce(m)
+        if len(self._memory) == 0:
+            return
+
+        # Exemplar mean
+        classes = np.unique(self._memory.targets)
+        means = self._stats_class_means(classes)
+        if means is None:
+            vectors = self._extract_cached_vectors(
+                data_manager, self._memory.positions
             )
-            vectors, _ = self._extract_vectors(idx_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            mean = np.mean(vectors, axis=0)
-            mean = mean / np.linalg.norm(mean)
+            classes, means = self._compute_class_means(vectors, self._memory.targets)
 
-            self._class_means[class_idx, :] = mean
+        self._class_means[classes, :] = means
 
     def _construct_exemplar(self, data_manager, m):
         logging.info("Constructing exemplars...({} per classes)".format(m))
-        for class_idx in range(self._known_classes, self._total_classes):
-            data, targets, idx_dataset = data_manager.get_dataset(
-                np.arange(class_idx, class_idx + 1),
-                source="train",
-                mode="test",
-                ret_data=True,
-            )
-            idx_loader = DataLoader(
-                idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4
-            )
-            vectors, _ = self._extract_vectors(idx_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            class_mean = np.mean(vectors, axis=0)
-
-            # Select
-            selected_exemplars = []
-            exemplar_vectors = []  # [n, feature_dim]
-            for k in range(1, m + 1):
-                S = np.sum(
-                    exemplar_vectors, axis=0
-                )  # [feature_dim] sum of selected exemplars vectors
-                mu_p = (vectors + S) / k  # [n, feature_dim] sum to all vectors
-                i = np.argmin(np.sqrt(np.sum((class_mean - mu_p) ** 2, axis=1)))
-                selected_exemplars.append(
-                    np.array(data[i])
-                )  # New object to avoid passing by inference
-                exemplar_vectors.append(
-                    np.array(vectors[i])
-                )  # New object to avoid passing by inference
-
-                vectors = np.delete(
-                    vectors, i, axis=0
-                )  # Remove it to avoid duplicative selection
-                data = np.delete(
-                    data, i, axis=0
-                )  # Remove it to avoid duplicative selection
-                
-                if len(vectors) == 0:
-                    break
-            # uniques = np.unique(selected_exemplars, axis=0)
-            # print('Unique elements: {}'.format(len(uniques)))
-            selected_exemplars = np.array(selected_exemplars)
-            # exemplar_targets = np.full(m, class_idx)
-            exemplar_targets = np.full(selected_exemplars.shape[0], class_idx)
-            self._data_memory = (
-                np.concatenate((self._data_memory, selected_exemplars))
-                if len(self._data_memory) != 0
-                else selected_exemplars
-            )
-            self._targets_memory = (
-                np.concatenate((self._targets_memory, exemplar_targets))
-                if len(self._targets_memory) != 0
-                else exemplar_targets
-            )
+        selected, exemplar_targets = self._select_new_exemplars(data_manager, m)
+        self._memory.extend(selected, exemplar_targets, data_manager)
 
-            # Exemplar mean
-            idx_dataset = data_manager.get_dataset(
-                [],
-                source="train",
-                mode="test",
-                appendent=(selected_exemplars, exemplar_targets),
-            )
-            idx_loader = DataLoader(
-                idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4
-            )
-            vectors, _ = self._extract_vectors(idx_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            mean = np.mean(vectors, axis=0)
-            mean = mean / np.linalg.norm(mean)
+        # Exemplar mean, the selected samples were already embedded above
+        classes = np.unique(exemplar_targets)
+        means = self._stats_class_means(classes)
+        if means is None:
+            vectors = self._extract_cached_vectors(data_manager, selected)
+            classes, means = self._compute_class_means(vectors, exemplar_targets)
 
-            self._class_means[class_idx, :] = mean
+        self._class_means[classes, :] = means
 
     def _construct_exemplar_unified(self, data_manager, m):
         logging.info(
             "Constructing exemplars for new classes...({} per classes)".format(m)
         )
+        self._feature_cache.reset()
         _class_means = np.zeros((self._total_classes, self.feature_dim))
 
         # Calculate the means of old classes with newly trained network
-        for class_idx in range(self._known_classes):
-            mask = np.where(self._targets_memory == class_idx)[0]
-            class_data, class_targets = (
-                self._data_memory[mask],
-                self._targets_memory[mask],
-            )
-
-            class_dset = data_manager.get_dataset(
-                [], source="train", mode="test", appendent=(class_data, class_targets)
-            )
-            class_loader = DataLoader(
-                class_dset, batch_size=batch_size, shuffle=False, num_workers=4
-            )
-            vectors, _ = self._extract_vectors(class_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            mean = np.mean(vectors, axis=0)
-            mean = mean / np.linalg.norm(mean)
+        if len(self._memory) != 0:
+            classes = np.unique(self._memory.targets)
+            means = self._stats_class_means(classes)
+            if means is None:
+                vectors = self._extract_cached_vectors(
+                    data_manager, self._memory.positions
+                )
+                classes, means = self._compute_class_means(
+                    vectors, self._memory.targets
+                )
 
-            _class_means[class_idx, :] = mean
+            _class_means[classes, :] = means
 
         # Construct exemplars for new classes and calculate the means
-        for class_idx in range(self._known_classes, self._total_classes):
-            data, targets, class_dset = data_manager.get_dataset(
-                np.arange(class_idx, class_idx + 1),
-                source="train",
-                mode="test",
-                ret_data=True,
-            )
-            class_loader = DataLoader(
-                class_dset, batch_size=batch_size, shuffle=False, num_workers=4
-            )
+        selected, exemplar_targets = self._select_new_exemplars(data_manager, m)
+        self._memory.extend(selected, exemplar_targets, data_manager)
 
-            vectors, _ = self._extract_vectors(class_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            class_mean = np.mean(vectors, axis=0)
-
-            # Select
-            selected_exemplars = []
-            exemplar_vectors = []
-            for k in range(1, m + 1):
-                S = np.sum(
-                    exemplar_vectors, axis=0
-                )  # [feature_dim] sum of selected exemplars vectors
-                mu_p = (vectors + S) / k  # [n, feature_dim] sum to all vectors
-                i = np.argmin(np.sqrt(np.sum((class_mean - mu_p) ** 2, axis=1)))
-
-                selected_exemplars.append(
-                    np.array(data[i])
-                )  # New object to avoid passing by inference
-                exemplar_vectors.append(
-                    np.array(vectors[i])
-                )  # New object to avoid passing by inference
-
-                vectors = np.delete(
-                    vectors, i, axis=0
-                )  # Remove it to avoid duplicative selection
-                data = np.delete(
-                    data, i, axis=0
-                )  # Remove it to avoid duplicative selection
-
-            selected_exemplars = np.array(selected_exemplars)
-            exemplar_targets = np.full(m, class_idx)
-            self._data_memory = (
-                np.concatenate((self._data_memory, selected_exemplars))
-                if len(self._data_memory) != 0
-                else selected_exemplars
-            )
-            self._targets_memory = (
-                np.concatenate((self._targets_memory, exemplar_targets))
-                if len(self._targets_memory) != 0
-                else exemplar_targets
-            )
+        # Exemplar mean, the selected samples were already embedded above
+        classes = np.unique(exemplar_targets)
+        means = self._stats_class_means(classes)
+        if means is None:
+            vectors = self._extract_cached_vectors(data_manager, selected)
+            classes, means = self._compute_class_means(vectors, exemplar_targets)
+        _class_means[classes, :] = means
 
-            # Exemplar mean
-            exemplar_dset = data_manager.get_dataset(
-                [],
-                source="train",
-                mode="test",
-                appendent=(selected_exemplars, exemplar_targets),
-            )
-            exemplar_loader = DataLoader(
-                exemplar_dset, batch_size=batch_size, shuffle=False, num_workers=4
-            )
-            vectors, _ = self._extract_vectors(exemplar_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            mean = np.mean(vectors, axis=0)
-            mean = mean / np.linalg.norm(mean)
+        self._class_means = _class_means
 
-            _class_means[class_idx, :] = mean
 
-        self._class_means = _class_means
+def _get_autocast_dtype(precision):
+    if precision == "fp32":
+        return None
+    elif precision == "bf16":
+        return torch.bfloat16
+    else:
+        raise ValueError("Unknown precision {}.".format(precision))
+
+
+def _to_float(outputs):
+    if isinstance(outputs, torch.Tensor):
+        return outputs.float() if outputs.is_floating_point() else outputs
+    elif isinstance(outputs, dict):
+        return {k: _to_float(v) for k, v in outputs.items()}
+    elif isinstance(outputs, (list, tuple)):
+        return type(outputs)(_to_float(v) for v in outputs)
+    return outputs
@@ -4,9 +4,9 @@ import torch
 from torch import nn
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
 from models.base import BaseLearner
 from utils.inc_net import IncrementalNetWithBias
+from utils.toolkit import tensor2numpy
 
 
 epochs = 170
@@ -53,8 +53,12 @@ class BiC(BaseLearner):
                     split_ratio * self._memory_size / self._known_classes
                 ),
             )
-            self.val_loader = DataLoader(
-                val_dset, batch_size=batch_size, shuffle=True, num_workers=num_workers
+            self.val_loader = self._loaders.get_loader(
+                "val",
+                val_dset,
+                batch_size=batch_size,
+                shuffle=True,
+                num_workers=num_workers,
             )
             logging.info(
                 "Stage1 dset: {}, Stage2 dset: {}".format(
@@ -74,11 +78,15 @@ class BiC(BaseLearner):
             np.arange(0, self._total_classes), source="test", mode="test"
         )
 
-        self.train_loader = DataLoader(
-            train_dset, batch_size=batch_size, shuffle=True, num_workers=num_workers
+        self.train_loader = self._get_train_loader(
+            train_dset, batch_size=batch_size, num_workers=num_workers
         )
-        self.test_loader = DataLoader(
-            test_dset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        self.test_loader = self._loaders.get_loader(
+            "test",
+            test_dset,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
         )
 
         self._log_bias_params()
@@ -96,14 +104,15 @@ class BiC(BaseLearner):
         for epoch in range(1, epochs + 1):
             self._network.train()
             losses = 0.0
-            for i, (_, inputs, targets) in enumerate(train_loader):
+            correct, total = 0, 0
+            for i, (idx, inputs, targets) in enumerate(train_loader):
                 inputs, targets = inputs.to(self._device), targets.to(self._device)
-                logits = self._network(inputs)["logits"]
+                logits = self._forward(self._network, inputs)["logits"]
 
                 if stage == "training":
                     clf_loss = F.cross_entropy(logits, targets)
                     if self._old_network is not None:
-                        old_logits = self._old_network(inputs)["logits"].detach()
+                        old_logits = self._teacher_forward(idx, inputs)["logits"].detach()
                         hat_pai_k = F.softmax(old_logits / T, dim=1)
                         log_pai_k = F.log_softmax(
                             logits[:, : self._known_classes] / T, dim=1
@@ -124,18 +133,35 @@ class BiC(BaseLearner):
                 optimizer.step()
                 losses += loss.item()
 
+                _, preds = torch.max(logits, dim=1)
+                correct += preds.eq(targets.expand_as(preds)).cpu().sum()
+                total += len(targets)
+
             scheduler.step()
-            train_acc = self._compute_accuracy(self._network, train_loader)
-            test_acc = self._compute_accuracy(self._network, test_loader)
-            info = "{} => Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.3f}, Test_accy {:.3f}".format(
-                stage,
-                self._cur_task,
-                epoch,
-                epochs,
-                losses / len(train_loader),
-                train_acc,
-                test_acc,
+            # Accuracy of the epoch's own forward passes, not of an extra pass
+            train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
+            test_acc = self._compute_epoch_accuracy(
+                self._network, test_loader, epoch - 1, epochs, every=1
             )
+            if test_acc is not None:
+                info = "{} => Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.3f}, Test_accy {:.3f}".format(
+                    stage,
+                    self._cur_task,
+                    epoch,
+                    epochs,
+                    losses / len(train_loader),
+                    train_acc,
+                    test_acc,
+                )
+            else:
+                info = "{} => Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.3f}".format(
+                    stage,
+                    self._cur_task,
+                    epoch,
+                    epochs,
+                    losses / len(train_loader),
+                    train_acc,
+                )
             logging.info(info)
 
     def _stage1_training(self, train_loader, test_loader):
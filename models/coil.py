@@ -4,15 +4,15 @@ from tqdm import tqdm
 import torch
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
 from models.base import BaseLearner
 from utils.inc_net import (
     IncrementalNet,
     CosineIncrementalNet,
     SimpleCosineIncrementalNet,
 )
+from utils.class_stats import ClassFeatureStats
+from utils.sinkhorn import sinkhorn
 from utils.toolkit import target2onehot, tensor2numpy
-import ot
 from torch import nn
 import copy
 
@@ -35,6 +35,7 @@ class COIL(BaseLearner):
         self.sinkhorn_reg = args["sinkhorn"]
         self.calibration_term = args["calibration_term"]
         self.args = args
+        self._ot_potentials = None
 
     def after_task(self):
         self.nextperiod_initialization = self.solving_ot()
@@ -50,13 +51,14 @@ class COIL(BaseLearner):
             self._extract_class_means(
                 self.data_manager, 0, self._total_classes + each_time_class_num
             )
-            former_class_means = torch.tensor(
-                self._ot_prototype_means[: self._total_classes]
+            former_class_means = torch.as_tensor(
+                self._ot_prototype_means[: self._total_classes], device=self._device
             )
-            next_period_class_means = torch.tensor(
+            next_period_class_means = torch.as_tensor(
                 self._ot_prototype_means[
                     self._total_classes : self._total_classes + each_time_class_num
-                ]
+                ],
+                device=self._device,
             )
             Q_cost_matrix = torch.cdist(
                 former_class_means, next_period_class_means, p=self.args["norm_term"]
@@ -68,8 +70,8 @@ class COIL(BaseLearner):
             _mu2_vec = (
                 torch.ones(len(next_period_class_means)) / len(former_class_means) * 1.0
             )
-            T = ot.sinkhorn(_mu1_vec, _mu2_vec, Q_cost_matrix, self.sinkhorn_reg)
-            T = torch.tensor(T).float().cuda()
+            T, _ = sinkhorn(_mu1_vec, _mu2_vec, Q_cost_matrix, self.sinkhorn_reg)
+            T = T.float()
             transformed_hat_W = torch.mm(
                 T.T, F.normalize(self._network.fc.weight, p=2, dim=1)
             )
@@ -86,17 +88,11 @@ class COIL(BaseLearner):
             )
         return transformed_hat_W * len(former_class_means) * self.calibration_term
 
-    def solving_ot_to_old(self):
+    def solving_ot_to_old(self, class_means):
+        """class_means: [total_classes, feature_dim] running means of the train features."""
         current_class_num = self.data_manager.get_task_size(self._cur_task)
-        self._extract_class_means_with_memory(
-            self.data_manager, self._known_classes, self._total_classes
-        )
-        former_class_means = torch.tensor(
-            self._ot_prototype_means[: self._known_classes]
-        )
-        next_period_class_means = torch.tensor(
-            self._ot_prototype_means[self._known_classes : self._total_classes]
-        )
+        former_class_means = class_means[: self._known_classes]
+        next_period_class_means = class_means[self._known_classes : self._total_classes]
         Q_cost_matrix = (
             torch.cdist(
                 next_period_class_means, former_class_means, p=self.args["norm_term"]
@@ -107,8 +103,14 @@ class COIL(BaseLearner):
         _mu2_vec = (
             torch.ones(len(next_period_class_means)) / len(former_class_means) * 1.0
         )
-        T = ot.sinkhorn(_mu2_vec, _mu1_vec, Q_cost_matrix, self.sinkhorn_reg)
-        T = torch.tensor(T).float().cuda()
+        # The classes only move a little between two refreshes
+        T, self._ot_potentials = sinkhorn(
+            _mu2_vec,
+            _mu1_vec,
+            Q_cost_matrix,
+            self.sinkhorn_reg,
+            init=self._ot_potentials,
+        )
         transformed_hat_W = torch.mm(
             T.T,
             F.normalize(self._network.fc.weight[-current_class_num:, :], p=2, dim=1),
@@ -135,14 +137,14 @@ class COIL(BaseLearner):
             mode="train",
             appendent=self._get_memory(),
         )
-        self.train_loader = DataLoader(
-            train_dataset, batch_size=batch_size, shuffle=True, num_workers=4
+        self.train_loader = self._get_train_loader(
+            train_dataset, batch_size=batch_size, num_workers=4
         )
         test_dataset = data_manager.get_dataset(
             np.arange(0, self._total_classes), source="test", mode="test"
         )
-        self.test_loader = DataLoader(
-            test_dataset, batch_size=batch_size, shuffle=False, num_workers=4
+        self.test_loader = self._loaders.get_loader(
+            "test", test_dataset, batch_size=batch_size, shuffle=False, num_workers=4
         )
 
         self._train(self.train_loader, self.test_loader)
@@ -162,6 +164,13 @@ class COIL(BaseLearner):
         self._update_representation(train_loader, test_loader, optimizer, scheduler)
 
     def _update_representation(self, train_loader, test_loader, optimizer, scheduler):
+        # Prototypes of the old (memory) and new classes for the OT to the old
+        # classifier, from the features of the last 200 steps
+        class_stats = ClassFeatureStats(
+            self._total_classes, self._network.feature_dim, self._device
+        )
+        class_means = None
+        self._ot_potentials = None
         prog_bar = tqdm(range(epochs))
         for _, epoch in enumerate(prog_bar):
             weight_ot_init = max(1.0 - (epoch / 2) ** 2, 0)
@@ -171,16 +180,23 @@ class COIL(BaseLearner):
             losses = 0.0
             correct, total = 0, 0
 
-            for i, (_, inputs, targets) in enumerate(train_loader):
+            for i, (idx, inputs, targets) in enumerate(train_loader):
                 inputs, targets = inputs.to(self._device), targets.to(self._device)
-                output = self._network(inputs)
+                output = self._forward(self._network, inputs)
                 logits = output["logits"]
                 onehots = target2onehot(targets, self._total_classes)
 
                 clf_loss = F.cross_entropy(logits, targets)
+                self._update_class_stats(
+                    epoch, epochs, inputs, targets, output["features"]
+                )
                 if self._old_network is not None:
+                    # The training features, whatever "class_stats" is
+                    class_stats.update(
+                        F.normalize(output["features"].detach(), p=2, dim=1), targets
+                    )
 
-                    old_logits = self._old_network(inputs)["logits"].detach()
+                    old_logits = self._teacher_forward(idx, inputs)["logits"].detach()
                     hat_pai_k = F.softmax(old_logits / T, dim=1)
                     log_pai_k = F.log_softmax(
                         logits[:, : self._known_classes] / T, dim=1
@@ -213,7 +229,13 @@ class COIL(BaseLearner):
                         features = F.normalize(output["features"], p=2, dim=1)
                         if i % 200 == 0:
                             with torch.no_grad():
-                                self._ot_old_branch = self.solving_ot_to_old()
+                                class_means = F.normalize(
+                                    class_stats.means(class_means), p=2, dim=1
+                                )
+                                class_stats.reset()
+                                self._ot_old_branch = self.solving_ot_to_old(
+                                    class_means
+                                )
                         old_logit_by_wold_init_by_ot = F.linear(
                             features, F.normalize(self._ot_old_branch, p=2, dim=1)
                         )
@@ -243,15 +265,26 @@ class COIL(BaseLearner):
 
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
-            test_acc = self._compute_accuracy(self._network, test_loader)
-            info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
-                self._cur_task,
-                epoch + 1,
-                epochs,
-                losses / len(train_loader),
-                train_acc,
-                test_acc,
+            test_acc = self._compute_epoch_accuracy(
+                self._network, test_loader, epoch, epochs, every=1
             )
+            if test_acc is not None:
+                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
+                    self._cur_task,
+                    epoch + 1,
+                    epochs,
+                    losses / len(train_loader),
+                    train_acc,
+                    test_acc,
+                )
+            else:
+                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}".format(
+                    self._cur_task,
+                    epoch + 1,
+                    epochs,
+                    losses / len(train_loader),
+                    train_acc,
+                )
             prog_bar.set_description(info)
 
         logging.info(info)
@@ -261,66 +294,17 @@ class COIL(BaseLearner):
             (data_manager.get_total_classnum(), self._network.feature_dim)
         )
         with torch.no_grad():
-            for class_idx in range(low, high):
-                data, targets, idx_dataset = data_manager.get_dataset(
-                    np.arange(class_idx, class_idx + 1),
-                    source="train",
-                    mode="test",
-                    ret_data=True,
-                )
-                idx_loader = DataLoader(
-                    idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4
-                )
-                vectors, _ = self._extract_vectors(idx_loader)
-                vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-                class_mean = np.mean(vectors, axis=0)
-                class_mean = class_mean / (np.linalg.norm(class_mean))
-                self._ot_prototype_means[class_idx, :] = class_mean
-        self._network.train()
-
-    def _extract_class_means_with_memory(self, data_manager, low, high):
-
-        self._ot_prototype_means = np.zeros(
-            (data_manager.get_total_classnum(), self._network.feature_dim)
-        )
-        memoryx, memoryy = self._data_memory, self._targets_memory
-        with torch.no_grad():
-            for class_idx in range(0, low):
-                idxes = np.where(
-                    np.logical_and(memoryy >= class_idx, memoryy < class_idx + 1)
-                )[0]
-                data, targets = memoryx[idxes], memoryy[idxes]
-                # idx_dataset=TensorDataset(data,targets)
-                # idx_loader = DataLoader(idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4)
-                _, _, idx_dataset = data_manager.get_dataset(
-                    [],
-                    source="train",
-                    appendent=(data, targets),
-                    mode="test",
-                    ret_data=True,
-                )
-                idx_loader = DataLoader(
-                    idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4
-                )
-                vectors, _ = self._extract_vectors(idx_loader)
-                vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-                class_mean = np.mean(vectors, axis=0)
-                class_mean = class_mean / np.linalg.norm(class_mean)
-                self._ot_prototype_means[class_idx, :] = class_mean
-
-            for class_idx in range(low, high):
-                data, targets, idx_dataset = data_manager.get_dataset(
-                    np.arange(class_idx, class_idx + 1),
-                    source="train",
-                    mode="test",
-                    ret_data=True,
-                )
-                idx_loader = DataLoader(
-                    idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4
-                )
-                vectors, _ = self._extract_vectors(idx_loader)
-                vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-                class_mean = np.mean(vectors, axis=0)
-                class_mean = class_mean / np.linalg.norm(class_mean)
-                self._ot_prototype_means[class_idx, :] = class_mean
+            idx_dataset = data_manager.get_dataset(
+                np.arange(low, high), source="train", mode="test"
+            )
+            idx_loader = self._loaders.get_loader(
+                "features",
+                idx_dataset,
+                batch_size=batch_size,
+                shuffle=False,
+                num_workers=4,
+            )
+            vectors, targets = self._extract_vectors(idx_loader)
+            classes, means = self._compute_class_means(vectors, targets)
+            self._ot_prototype_means[classes, :] = means
         self._network.train()
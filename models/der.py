@@ -5,7 +5,6 @@ import torch
 from torch import nn
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
 from models.base import BaseLearner
 from utils.inc_net import DERNet, IncrementalNet
 from utils.toolkit import count_parameters, target2onehot, tensor2numpy
@@ -65,14 +64,22 @@ class DER(BaseLearner):
             mode="train",
             appendent=self._get_memory(),
         )
-        self.train_loader = DataLoader(
-            train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers
+        self.train_loader = self._loaders.get_loader(
+            "train",
+            train_dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            num_workers=num_workers,
         )
         test_dataset = data_manager.get_dataset(
             np.arange(0, self._total_classes), source="test", mode="test"
         )
-        self.test_loader = DataLoader(
-            test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        self.test_loader = self._loaders.get_loader(
+            "test",
+            test_dataset,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
         )
 
         if len(self._multiple_gpus) > 1:
@@ -138,7 +145,11 @@ class DER(BaseLearner):
             correct, total = 0, 0
             for i, (_, inputs, targets) in enumerate(train_loader):
                 inputs, targets = inputs.to(self._device), targets.to(self._device)
-                logits = self._network(inputs)["logits"]
+                outputs = self._forward(self._network, inputs)
+                logits = outputs["logits"]
+                self._update_class_stats(
+                    epoch, init_epoch, inputs, targets, outputs["features"]
+                )
 
                 loss = F.cross_entropy(logits, targets)
                 optimizer.zero_grad()
@@ -153,8 +164,10 @@ class DER(BaseLearner):
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
 
-            if epoch % 5 == 0:
-                test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._compute_epoch_accuracy(
+                self._network, test_loader, epoch, init_epoch
+            )
+            if test_acc is not None:
                 info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
                     self._cur_task,
                     epoch + 1,
@@ -185,8 +198,11 @@ class DER(BaseLearner):
             correct, total = 0, 0
             for i, (_, inputs, targets) in enumerate(train_loader):
                 inputs, targets = inputs.to(self._device), targets.to(self._device)
-                outputs = self._network(inputs)
+                outputs = self._forward(self._network, inputs)
                 logits, aux_logits = outputs["logits"], outputs["aux_logits"]
+                self._update_class_stats(
+                    epoch, epochs, inputs, targets, outputs["features"]
+                )
                 loss_clf = F.cross_entropy(logits, targets)
                 aux_targets = targets.clone()
                 aux_targets = torch.where(
@@ -210,8 +226,10 @@ class DER(BaseLearner):
 
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
-            if epoch % 5 == 0:
-                test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._compute_epoch_accuracy(
+                self._network, test_loader, epoch, epochs
+            )
+            if test_acc is not None:
                 info = "Task {}, Epoch {}/{} => Loss {:.3f}, Loss_clf {:.3f}, Loss_aux {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
                     self._cur_task,
                     epoch + 1,
@@ -5,7 +5,6 @@ import torch
 from torch import nn
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
 from models.base import BaseLearner
 from models.podnet import pod_spatial_loss
 from utils.inc_net import IncrementalNet
@@ -30,12 +29,16 @@ num_workers = 4
 T = 2
 lamda = 1000
 fishermax = 0.0001
+fisher_chunk_size = 32  # samples per vmap call in the per_sample Fisher mode
 
 
 class EWC(BaseLearner):
     def __init__(self, args):
         super().__init__(args)
         self.fisher = None
+        # Fisher and anchor of the penalty, over the current parameters
+        self._fisher_flat = None
+        self._mean_flat = None
         self._network = IncrementalNet(args["convnet_type"], False)
 
     def after_task(self):
@@ -56,14 +59,22 @@ class EWC(BaseLearner):
             source="train",
             mode="train",
         )
-        self.train_loader = DataLoader(
-            train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers
+        self.train_loader = self._loaders.get_loader(
+            "train",
+            train_dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            num_workers=num_workers,
         )
         test_dataset = data_manager.get_dataset(
             np.arange(0, self._total_classes), source="test", mode="test"
         )
-        self.test_loader = DataLoader(
-            test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        self.test_loader = self._loaders.get_loader(
+            "test",
+            test_dataset,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
         )
 
         if len(self._multiple_gpus) > 1:
@@ -72,22 +83,16 @@ class EWC(BaseLearner):
         if len(self._multiple_gpus) > 1:
             self._network = self._network.module
 
-        if self.fisher is None:
-            self.fisher = self.getFisherDiagonal(self.train_loader)
-        else:
+        fisher = self.getFisherDiagonal(self.train_loader)
+        if self.fisher is not None:
             alpha = self._known_classes / self._total_classes
-            new_finsher = self.getFisherDiagonal(self.train_loader)
-            for n, p in new_finsher.items():
-                new_finsher[n][: len(self.fisher[n])] = (
-                    alpha * self.fisher[n]
-                    + (1 - alpha) * new_finsher[n][: len(self.fisher[n])]
-                )
-            self.fisher = new_finsher
-        self.mean = {
-            n: p.clone().detach()
-            for n, p in self._network.named_parameters()
-            if p.requires_grad
-        }
+            old_fisher, covered = self._expand(self.fisher)
+            fisher = torch.where(
+                covered, alpha * old_fisher + (1 - alpha) * fisher, fisher
+            )
+        self.fisher = fisher
+        self.mean = self._flat_params().detach().clone()
+        self._layout = [p.shape for p in self._ewc_params()]
 
     def _train(self, train_loader, test_loader):
         self._network.to(self._device)
@@ -133,7 +138,7 @@ class EWC(BaseLearner):
             correct, total = 0, 0
             for i, (_, inputs, targets) in enumerate(train_loader):
                 inputs, targets = inputs.to(self._device), targets.to(self._device)
-                logits = self._network(inputs)["logits"]
+                logits = self._forward(self._network, inputs)["logits"]
                 loss = F.cross_entropy(logits, targets)
                 optimizer.zero_grad()
                 loss.backward()
@@ -147,29 +152,34 @@ class EWC(BaseLearner):
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
 
-            if epoch % 5 == 0:
-                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}".format(
+            test_acc = self._compute_epoch_accuracy(
+                self._network, test_loader, epoch, init_epoch, skip_every=True
+            )
+            if test_acc is not None:
+                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
                     self._cur_task,
                     epoch + 1,
                     init_epoch,
                     losses / len(train_loader),
                     train_acc,
+                    test_acc,
                 )
             else:
-                test_acc = self._compute_accuracy(self._network, test_loader)
-                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
+                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}".format(
                     self._cur_task,
                     epoch + 1,
                     init_epoch,
                     losses / len(train_loader),
                     train_acc,
-                    test_acc,
                 )
             prog_bar.set_description(info)
 
         logging.info(info)
 
     def _update_representation(self, train_loader, test_loader, optimizer, scheduler):
+        # Zero Fisher on the fc rows added since, so they are not penalized
+        self._fisher_flat, _ = self._expand(self.fisher)
+        self._mean_flat, _ = self._expand(self.mean)
         prog_bar = tqdm(range(epochs))
         for _, epoch in enumerate(prog_bar):
             self._network.train()
@@ -177,7 +187,7 @@ class EWC(BaseLearner):
             correct, total = 0, 0
             for i, (_, inputs, targets) in enumerate(train_loader):
                 inputs, targets = inputs.to(self._device), targets.to(self._device)
-                logits = self._network(inputs)["logits"]
+                logits = self._forward(self._network, inputs)["logits"]
 
                 loss_clf = F.cross_entropy(
                     logits[:, self._known_classes :], targets - self._known_classes
@@ -196,8 +206,10 @@ class EWC(BaseLearner):
 
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
-            if epoch % 5 == 0:
-                test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._compute_epoch_accuracy(
+                self._network, test_loader, epoch, epochs
+            )
+            if test_acc is not None:
                 info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
                     self._cur_task,
                     epoch + 1,
@@ -218,47 +230,120 @@ class EWC(BaseLearner):
         logging.info(info)
 
     def compute_ewc(self):
-        loss = 0
-        if len(self._multiple_gpus) > 1:
-            for n, p in self._network.module.named_parameters():
-                if n in self.fisher.keys():
-                    loss += (
-                        torch.sum(
-                            (self.fisher[n])
-                            * (p[: len(self.mean[n])] - self.mean[n]).pow(2)
-                        )
-                        / 2
-                    )
-        else:
-            for n, p in self._network.named_parameters():
-                if n in self.fisher.keys():
-                    loss += (
-                        torch.sum(
-                            (self.fisher[n])
-                            * (p[: len(self.mean[n])] - self.mean[n]).pow(2)
-                        )
-                        / 2
-                    )
-        return loss
+        return (
+            torch.sum(self._fisher_flat * (self._flat_params() - self._mean_flat).pow(2))
+            / 2
+        )
 
     def getFisherDiagonal(self, train_loader):
-        fisher = {
-            n: torch.zeros(p.shape).to(self._device)
-            for n, p in self._network.named_parameters()
-            if p.requires_grad
-        }
+        """
+        Diagonal empirical Fisher from the first "fisher_max_samples" samples of
+        the loader (all by default). "fisher_mode" picks what is squared and
+        averaged: the gradient of each batch ("batch", the default) or of each
+        sample ("per_sample", computed with torch.func, batch norm in eval mode).
+        """
+        params = self._ewc_params()
+        fisher = torch.zeros(sum(p.numel() for p in params), device=self._device)
+        # Per-parameter views, accumulated in place
+        views = [
+            f.view_as(p) for f, p in zip(fisher.split([p.numel() for p in params]), params)
+        ]
+        mode = self.args.get("fisher_mode", "batch")
+        if mode == "batch":
+            count = self._batch_fisher(train_loader, params, views)
+        elif mode == "per_sample":
+            count = self._per_sample_fisher(train_loader, views)
+        else:
+            raise ValueError("Unknown fisher_mode {}.".format(mode))
+        if count == 0:
+            raise ValueError(
+                "No samples to estimate the Fisher from (empty loader or "
+                "fisher_max_samples=0)."
+            )
+        fisher /= count
+        return fisher.clamp_(max=fishermax)
+
+    def _batch_fisher(self, train_loader, params, views):
         self._network.train()
         optimizer = optim.SGD(self._network.parameters(), lr=lrate)
-        for i, (_, inputs, targets) in enumerate(train_loader):
-            inputs, targets = inputs.to(self._device), targets.to(self._device)
-            logits = self._network(inputs)["logits"]
+        nb_batches = 0
+        for inputs, targets in self._fisher_batches(train_loader):
+            logits = self._forward(self._network, inputs)["logits"]
             loss = torch.nn.functional.cross_entropy(logits, targets)
             optimizer.zero_grad()
             loss.backward()
-            for n, p in self._network.named_parameters():
+            for view, p in zip(views, params):
                 if p.grad is not None:
-                    fisher[n] += p.grad.pow(2).clone()
-        for n, p in fisher.items():
-            fisher[n] = p / len(train_loader)
-            fisher[n] = torch.min(fisher[n], torch.tensor(fishermax))
-        return fisher
+                    view.addcmul_(p.grad, p.grad)
+            nb_batches += 1
+        return nb_batches
+
+    def _per_sample_fisher(self, train_loader, views):
+        from torch.func import functional_call, grad, vmap  # torch >= 2.0
+
+        network = self._network
+        if isinstance(network, nn.DataParallel):
+            network = network.module
+        # Batch statistics are undefined for one sample
+        network.eval()
+        params = {
+            n: p.detach() for n, p in network.named_parameters() if p.requires_grad
+        }
+        buffers = dict(network.named_buffers())
+
+        def sample_loss(params, input, target):
+            logits = functional_call(network, (params, buffers), (input[None],))[
+                "logits"
+            ]
+            return F.cross_entropy(logits, target[None])
+
+        sample_grads = vmap(
+            grad(sample_loss), in_dims=(None, 0, 0), chunk_size=fisher_chunk_size
+        )
+        nb_samples = 0
+        for inputs, targets in self._fisher_batches(train_loader):
+            grads = sample_grads(params, inputs, targets)
+            for view, g in zip(views, grads.values()):
+                view.add_(g.pow_(2).sum(dim=0))
+            nb_samples += len(targets)
+        return nb_samples
+
+    def _fisher_batches(self, train_loader):
+        max_samples = self.args.get("fisher_max_samples", None)
+        nb_samples = 0
+        for i, (_, inputs, targets) in enumerate(train_loader):
+            if max_samples is not None:
+                if nb_samples >= max_samples:
+                    break
+                inputs = inputs[: max_samples - nb_samples]
+                targets = targets[: max_samples - nb_samples]
+            nb_samples += len(targets)
+            yield inputs.to(self._device), targets.to(self._device)
+
+    def _ewc_params(self):
+        network = self._network
+        if isinstance(network, nn.DataParallel):
+            network = network.module
+        return [p for p in network.parameters() if p.requires_grad]
+
+    def _flat_params(self):
+        return torch.cat([p.reshape(-1) for p in self._ewc_params()])
+
+    def _expand(self, flat):
+        """
+        Lays `flat`, saved for the parameters of the last task, out over the
+        current ones: the fc grows by rows, so the saved values of a parameter
+        are a prefix of it. Also returns the mask of the positions they cover.
+        """
+        params = self._ewc_params()
+        expanded = flat.new_zeros(sum(p.numel() for p in params))
+        covered = torch.zeros(len(expanded), dtype=torch.bool, device=flat.device)
+        src, dst = 0, 0
+        for shape, p in zip(self._layout, params):
+            numel = shape.numel()
+            expanded[dst : dst + numel] = flat[src : src + numel]
+            covered[dst : dst + numel] = True
+            src, dst = src + numel, dst + p.numel()
+
+        return expanded, covered
+
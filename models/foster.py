@@ -5,7 +5,6 @@ import torch
 from torch import nn
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
 from models.base import BaseLearner
 from utils.inc_net import FOSTERNet
 from utils.toolkit import count_parameters, target2onehot, tensor2numpy
@@ -65,7 +64,8 @@ class FOSTER(BaseLearner):
             mode="train",
             appendent=self._get_memory(),
         )
-        self.train_loader = DataLoader(
+        self.train_loader = self._loaders.get_loader(
+            "train",
             train_dataset,
             batch_size=self.args["batch_size"],
             shuffle=True,
@@ -75,7 +75,8 @@ class FOSTER(BaseLearner):
         test_dataset = data_manager.get_dataset(
             np.arange(0, self._total_classes), source="test", mode="test"
         )
-        self.test_loader = DataLoader(
+        self.test_loader = self._loaders.get_loader(
+            "test",
             test_dataset,
             batch_size=self.args["batch_size"],
             shuffle=False,
@@ -186,7 +187,7 @@ class FOSTER(BaseLearner):
                 inputs, targets = inputs.to(
                     self._device, non_blocking=True
                 ), targets.to(self._device, non_blocking=True)
-                logits = self._network(inputs)["logits"]
+                logits = self._forward(self._network, inputs)["logits"]
                 loss = F.cross_entropy(logits, targets)
                 optimizer.zero_grad()
                 loss.backward()
@@ -197,23 +198,25 @@ class FOSTER(BaseLearner):
                 total += len(targets)
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
-            if epoch % 5 == 0:
-                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}".format(
+            test_acc = self._compute_epoch_accuracy(
+                self._network, test_loader, epoch, self.args["init_epochs"], skip_every=True
+            )
+            if test_acc is not None:
+                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
                     self._cur_task,
                     epoch + 1,
                     self.args["init_epochs"],
                     losses / len(train_loader),
                     train_acc,
+                    test_acc,
                 )
             else:
-                test_acc = self._compute_accuracy(self._network, test_loader)
-                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
+                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}".format(
                     self._cur_task,
                     epoch + 1,
                     self.args["init_epochs"],
                     losses / len(train_loader),
                     train_acc,
-                    test_acc,
                 )
             prog_bar.set_description(info)
             logging.info(info)
@@ -231,7 +234,7 @@ class FOSTER(BaseLearner):
                 inputs, targets = inputs.to(
                     self._device, non_blocking=True
                 ), targets.to(self._device, non_blocking=True)
-                outputs = self._network(inputs)
+                outputs = self._forward(self._network, inputs)
                 logits, fe_logits, old_logits = (
                     outputs["logits"],
                     outputs["fe_logits"],
@@ -266,8 +269,10 @@ class FOSTER(BaseLearner):
                 total += len(targets)
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
-            if epoch % 5 == 0:
-                test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._compute_epoch_accuracy(
+                self._network, test_loader, epoch, self.args["boosting_epochs"]
+            )
+            if test_acc is not None:
                 info = "Task {}, Epoch {}/{} => Loss {:.3f}, Loss_clf {:.3f}, Loss_fe {:.3f}, Loss_kd {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
                     self._cur_task,
                     epoch + 1,
@@ -325,9 +330,9 @@ class FOSTER(BaseLearner):
                 inputs, targets = inputs.to(
                     self._device, non_blocking=True
                 ), targets.to(self._device, non_blocking=True)
-                dark_logits = self._snet(inputs)["logits"]
+                dark_logits = self._forward(self._snet, inputs)["logits"]
                 with torch.no_grad():
-                    outputs = self._network(inputs)
+                    outputs = self._forward(self._network, inputs)
                     logits, old_logits, fe_logits = (
                         outputs["logits"],
                         outputs["old_logits"],
@@ -344,8 +349,10 @@ class FOSTER(BaseLearner):
                 total += len(targets)
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
-            if epoch % 5 == 0:
-                test_acc = self._compute_accuracy(self._snet, test_loader)
+            test_acc = self._compute_epoch_accuracy(
+                self._snet, test_loader, epoch, self.args["compression_epochs"]
+            )
+            if test_acc is not None:
                 info = "SNet: Task {}, Epoch {}/{} => Loss {:.3f},  Train_accy {:.2f}, Test_accy {:.2f}".format(
                     self._cur_task,
                     epoch + 1,
@@ -380,7 +387,7 @@ class FOSTER(BaseLearner):
         for _, (_, inputs, targets) in enumerate(test_loader):
             inputs = inputs.to(self._device, non_blocking=True)
             with torch.no_grad():
-                outputs = self._snet(inputs)["logits"]
+                outputs = self._forward(self._snet, inputs)["logits"]
             predicts = torch.topk(
                 outputs, k=self.topk, dim=1, largest=True, sorted=True
             )[1]
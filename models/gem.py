@@ -1,4 +1,5 @@
 import logging
+import math
 import numpy as np
 from torch._C import device
 from tqdm import tqdm
@@ -6,15 +7,10 @@ import torch
 from torch import nn
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
 from models.base import BaseLearner
 from utils.inc_net import IncrementalNet
 from utils.inc_net import CosineIncrementalNet
 from utils.toolkit import target2onehot, tensor2numpy
-try:
-    from quadprog import solve_qp
-except:
-    pass
 
 
 EPSILON = 1e-8
@@ -35,6 +31,10 @@ batch_size = 128
 weight_decay = 2e-4
 num_workers = 4
 
+# Projection of the gradient onto the GEM constraints
+qp_max_iter = 1000
+qp_tol = 1e-6
+
 
 class GEM(BaseLearner):
     def __init__(self, args):
@@ -63,29 +63,37 @@ class GEM(BaseLearner):
             source="train",
             mode="train",
         )
-        self.train_loader = DataLoader(
-            train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers
+        self.train_loader = self._loaders.get_loader(
+            "train",
+            train_dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            num_workers=num_workers,
         )
         test_dataset = data_manager.get_dataset(
             np.arange(0, self._total_classes), source="test", mode="test"
         )
-        self.test_loader = DataLoader(
-            test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        self.test_loader = self._loaders.get_loader(
+            "test",
+            test_dataset,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
         )
 
         if self._cur_task > 0:
-            previous_dataset = data_manager.get_dataset(
-                [], source="train", mode="train", appendent=self._get_memory()
+            # Drawn from and augmented at every step, see _memory_batch
+            previous_dataset = data_manager.get_memory_dataset(
+                self._get_memory(), device=self._device
             )
-
-            self.previous_data = []
-            self.previous_label = []
-            for i in previous_dataset:
-                _, data_, label_ = i
-                self.previous_data.append(data_)
-                self.previous_label.append(label_)
-            self.previous_data = torch.stack(self.previous_data)
-            self.previous_label = torch.tensor(self.previous_label)
+            self.previous_label = torch.as_tensor(previous_dataset.labels)
+            if hasattr(previous_dataset, "get_batch"):
+                self.previous_data = previous_dataset
+            else:
+                # Per-sample transforms: augmented once for the whole task
+                self.previous_data = torch.stack(
+                    [previous_dataset[idx][1] for idx in range(len(previous_dataset))]
+                )
         # Procedure
         if len(self._multiple_gpus) > 1:
             self._network = nn.DataParallel(self._network, self._multiple_gpus)
@@ -141,7 +149,7 @@ class GEM(BaseLearner):
             correct, total = 0, 0
             for i, (_, inputs, targets) in enumerate(train_loader):
                 inputs, targets = inputs.to(self._device), targets.to(self._device)
-                logits = self._network(inputs)["logits"]
+                logits = self._forward(self._network, inputs)["logits"]
 
                 loss = F.cross_entropy(logits, targets)
                 optimizer.zero_grad()
@@ -156,23 +164,25 @@ class GEM(BaseLearner):
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
 
-            if epoch % 5 == 0:
-                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}".format(
+            test_acc = self._compute_epoch_accuracy(
+                self._network, test_loader, epoch, init_epoch, skip_every=True
+            )
+            if test_acc is not None:
+                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
                     self._cur_task,
                     epoch + 1,
                     init_epoch,
                     losses / len(train_loader),
                     train_acc,
+                    test_acc,
                 )
             else:
-                test_acc = self._compute_accuracy(self._network, test_loader)
-                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
+                info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}".format(
                     self._cur_task,
                     epoch + 1,
                     init_epoch,
                     losses / len(train_loader),
                     train_acc,
-                    test_acc,
                 )
             prog_bar.set_description(info)
 
@@ -180,47 +190,50 @@ class GEM(BaseLearner):
 
     def _update_representation(self, train_loader, test_loader, optimizer, scheduler):
         prog_bar = tqdm(range(epochs))
-        grad_numels = []
-        for params in self._network.parameters():
-            grad_numels.append(params.data.numel())
-        G = torch.zeros((sum(grad_numels), self._cur_task + 1)).to(self._device)
-
+        params = list(self._network.parameters())
+        numels = [p.numel() for p in params]
+        # Flat gradients of the old tasks, then of the current one, one row each
+        G = torch.zeros((self._cur_task + 1, sum(numels)), device=self._device)
+
+        # The old-task gradients come from at most "gem_mem_batch" memory samples
+        # per task (A-GEM style), and are only recomputed every
+        # "gem_refresh_every" steps. The defaults use all of them at every step.
+        mem_batch = self.args.get("gem_mem_batch", None)
+        refresh_every = self.args.get("gem_refresh_every", 1)
+        incremental_step = self._total_classes - self._known_classes
+        task_masks = [
+            torch.where(
+                (self.previous_label >= k * incremental_step)
+                & (self.previous_label < (k + 1) * incremental_step)
+            )[0]
+            for k in range(0, self._cur_task)
+        ]
+
+        step = 0
         for _, epoch in enumerate(prog_bar):
             self._network.train()
             losses = 0.0
             correct, total = 0, 0
             for i, (_, inputs, targets) in enumerate(train_loader):
-                incremental_step = self._total_classes - self._known_classes
-                for k in range(0, self._cur_task):
-                    optimizer.zero_grad()
-                    mask = torch.where(
-                        (self.previous_label >= k * incremental_step)
-                        & (self.previous_label < (k + 1) * incremental_step)
-                    )[0]
-                    data_ = self.previous_data[mask].to(self._device)
-                    label_ = self.previous_label[mask].to(self._device)
-                    pred_ = self._network(data_)["logits"]
-                    pred_[:, : k * incremental_step].data.fill_(-10e10)
-                    pred_[:, (k + 1) * incremental_step :].data.fill_(-10e10)
-                    loss_ = F.cross_entropy(pred_, label_)
-                    loss_.backward()
-
-                    j = 0
-                    for params in self._network.parameters():
-                        if params is not None:
-                            if j == 0:
-                                stpt = 0
-                            else:
-                                stpt = sum(grad_numels[:j])
-
-                            endpt = sum(grad_numels[: j + 1])
-                            G[stpt:endpt, k].data.copy_(params.grad.data.view(-1))
-                            j += 1
-
-                    optimizer.zero_grad()
+                if step % refresh_every == 0:
+                    for k, mask in enumerate(task_masks):
+                        optimizer.zero_grad()
+                        if mem_batch is not None and len(mask) > mem_batch:
+                            mask = mask[torch.randperm(len(mask))[:mem_batch]]
+                        data_ = _memory_batch(self.previous_data, mask).to(self._device)
+                        label_ = self.previous_label[mask].to(self._device)
+                        pred_ = self._forward(self._network, data_)["logits"]
+                        pred_[:, : k * incremental_step].data.fill_(-10e10)
+                        pred_[:, (k + 1) * incremental_step :].data.fill_(-10e10)
+                        loss_ = F.cross_entropy(pred_, label_)
+                        loss_.backward()
+                        _flatten_grads(params, G[k])
+
+                        optimizer.zero_grad()
+                step += 1
 
                 inputs, targets = inputs.to(self._device), targets.to(self._device)
-                logits = self._network(inputs)["logits"]
+                logits = self._forward(self._network, inputs)["logits"]
                 logits[:, : self._known_classes].data.fill_(-10e10)
                 loss_clf = F.cross_entropy(logits, targets)
 
@@ -228,60 +241,17 @@ class GEM(BaseLearner):
 
                 optimizer.zero_grad()
                 loss.backward()
-
-                j = 0
-                for params in self._network.parameters():
-                    if params is not None:
-                        if j == 0:
-                            stpt = 0
-                        else:
-                            stpt = sum(grad_numels[:j])
-
-                        endpt = sum(grad_numels[: j + 1])
-                        G[stpt:endpt, self._cur_task].data.copy_(
-                            params.grad.data.view(-1)
-                        )
-                        j += 1
-
-                dotprod = torch.mm(
-                    G[:, self._cur_task].unsqueeze(0), G[:, : self._cur_task]
-                )
-
-                if (dotprod < 0).sum() > 0:
-
-                    old_grad = G[:, : self._cur_task].cpu().t().double().numpy()
-                    cur_grad = G[:, self._cur_task].cpu().contiguous().double().numpy()
-
-                    C = old_grad @ old_grad.T
-                    p = old_grad @ cur_grad
-                    A = np.eye(old_grad.shape[0])
-                    b = np.zeros(old_grad.shape[0])
-
-                    v = solve_qp(C, -p, A, b)[0]
-
-                    new_grad = old_grad.T @ v + cur_grad
-                    new_grad = torch.tensor(new_grad).float().to(self._device)
-
-                    new_dotprod = torch.mm(
-                        new_grad.unsqueeze(0), G[:, : self._cur_task]
-                    )
-                    if (new_dotprod < -0.01).sum() > 0:
-                        assert 0
-                    j = 0
-                    for params in self._network.parameters():
-                        if params is not None:
-                            if j == 0:
-                                stpt = 0
-                            else:
-                                stpt = sum(grad_numels[:j])
-
-                            endpt = sum(grad_numels[: j + 1])
-                            params.grad.data.copy_(
-                                new_grad[stpt:endpt]
-                                .contiguous()
-                                .view(params.grad.data.size())
-                            )
-                            j += 1
+                _flatten_grads(params, G[self._cur_task])
+
+                old_grad, cur_grad = G[: self._cur_task], G[self._cur_task]
+                # Both checks sync with the host, as does the solver's stopping test
+                if (old_grad @ cur_grad < 0).any():
+                    new_grad = project2cone(old_grad, cur_grad)
+                    assert not (
+                        old_grad @ new_grad < -0.01
+                    ).any(), "Projected gradient violates a GEM constraint."
+                    for param, grad in zip(params, new_grad.split(numels)):
+                        param.grad.copy_(grad.view_as(param))
 
                 optimizer.step()
                 losses += loss.item()
@@ -292,8 +262,10 @@ class GEM(BaseLearner):
 
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
-            if epoch % 5 == 0:
-                test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._compute_epoch_accuracy(
+                self._network, test_loader, epoch, epochs
+            )
+            if test_acc is not None:
                 info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
                     self._cur_task,
                     epoch + 1,
@@ -312,3 +284,46 @@ class GEM(BaseLearner):
                 )
             prog_bar.set_description(info)
         logging.info(info)
+
+
+def _memory_batch(data, indices):
+    if isinstance(data, torch.Tensor):
+        return data[indices]
+    return data.get_batch(indices)
+
+
+def _flatten_grads(params, out):
+    torch.cat([p.grad.reshape(-1) for p in params], out=out)
+
+
+def project2cone(old_grad, cur_grad, max_iter=qp_max_iter, tol=qp_tol):
+    """
+    old_grad: [nb_old_tasks, n], cur_grad: [n].
+    Closest gradient to cur_grad that has no negative dot product with any row
+    of old_grad. The GEM dual  min_v 1/2 v'Cv + p'v, v >= 0  is only
+    nb_old_tasks wide, and is solved where the gradients are with accelerated
+    projected gradient on its Jacobi-scaled form.
+    """
+    C = old_grad @ old_grad.T
+    p = old_grad @ cur_grad
+    # v = d * w gives the dual a unit diagonal
+    d = C.diagonal().clamp_min(EPSILON).rsqrt()
+    C = d[:, None] * C * d[None, :]
+    p = d * p
+    step = 1 / torch.linalg.eigvalsh(C)[-1]
+
+    w = torch.zeros_like(p)
+    z, t = w, 1.0
+    for it in range(max_iter):
+        w_next = (z - step * (C @ z + p)).clamp_min(0)
+        t_next = (1 + math.sqrt(1 + 4 * t * t)) / 2
+        z = w_next + ((t - 1) / t_next) * (w_next - w)
+        w, t = w_next, t_next
+        if (it + 1) % 25 == 0:
+            # KKT residual, zero at the optimum; checking it syncs with the host
+            grad = C @ w + p
+            residual = torch.where(w > 0, grad, grad.clamp_max(0)).abs().max()
+            if residual <= tol * p.abs().max():
+                break
+
+    return old_grad.T @ (d * w) + cur_grad
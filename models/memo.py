@@ -6,7 +6,6 @@ from torch import nn
 import copy
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
 from models.base import BaseLearner
 from utils.inc_net import AdaptiveNet
 from utils.toolkit import count_parameters, target2onehot, tensor2numpy
@@ -62,11 +61,12 @@ class MEMO(BaseLearner):
             mode='train', 
             appendent=self._get_memory()
         )
-        self.train_loader = DataLoader(
-            train_dataset, 
-            batch_size=self.args["batch_size"], 
-            shuffle=True, 
-            num_workers=num_workers
+        self.train_loader = self._loaders.get_loader(
+            "train",
+            train_dataset,
+            batch_size=self.args["batch_size"],
+            shuffle=True,
+            num_workers=num_workers,
         )
         
         test_dataset = data_manager.get_dataset(
@@ -74,11 +74,12 @@ class MEMO(BaseLearner):
             source='test', 
             mode='test'
         )
-        self.test_loader = DataLoader(
-            test_dataset, 
+        self.test_loader = self._loaders.get_loader(
+            "test",
+            test_dataset,
             batch_size=self.args["batch_size"],
-            shuffle=False, 
-            num_workers=num_workers
+            shuffle=False,
+            num_workers=num_workers,
         )
 
         if len(self._multiple_gpus) > 1:
@@ -180,7 +181,7 @@ class MEMO(BaseLearner):
             correct, total = 0, 0
             for i, (_, inputs, targets) in enumerate(train_loader):
                 inputs, targets = inputs.to(self._device), targets.to(self._device)
-                logits = self._network(inputs)['logits']
+                logits = self._forward(self._network, inputs)['logits']
 
                 loss=F.cross_entropy(logits,targets) 
                 optimizer.zero_grad()
@@ -194,8 +195,8 @@ class MEMO(BaseLearner):
 
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct)*100 / total, decimals=2)
-            if epoch%5==0:
-                test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._compute_epoch_accuracy(self._network, test_loader, epoch, self.args['init_epoch'])
+            if test_acc is not None:
                 info = 'Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}'.format(
                 self._cur_task, epoch+1, self.args['init_epoch'], losses/len(train_loader), train_acc, test_acc)
             else:
@@ -215,7 +216,7 @@ class MEMO(BaseLearner):
             for i, (_, inputs, targets) in enumerate(train_loader):
                 inputs, targets = inputs.to(self._device), targets.to(self._device)
 
-                outputs= self._network(inputs)
+                outputs= self._forward(self._network, inputs)
                 logits,aux_logits=outputs["logits"],outputs["aux_logits"]
                 loss_clf=F.cross_entropy(logits,targets)
                 aux_targets = targets.clone()
@@ -236,8 +237,8 @@ class MEMO(BaseLearner):
 
             scheduler.step()
             train_acc = np.around(tensor2numpy(correct)*100 / total, decimals=2)
-            if epoch%5==0:
-                test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._compute_epoch_accuracy(self._network, test_loader, epoch, self.args["epochs"])
+            if test_acc is not None:
                 info = 'Task {}, Epoch {}/{} => Loss {:.3f}, Loss_clf {:.3f}, Loss_aux  {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}'.format(
                 self._cur_task, epoch+1, self.args["epochs"], losses/len(train_loader),losses_clf/len(train_loader),losses_aux/len(train_loader),train_acc, test_acc)
             else:
@@ -4,7 +4,7 @@ import numpy as np
 import torch
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
+from torch.autograd.function import once_differentiable
 from models.base import BaseLearner
 from utils.inc_net import CosineIncrementalNet
 from utils.toolkit import tensor2numpy
@@ -82,11 +82,18 @@ class PODNet(BaseLearner):
         test_dset = data_manager.get_dataset(
             np.arange(0, self._total_classes), source="test", mode="test"
         )
-        self.train_loader = DataLoader(
-            train_dset, batch_size=batch_size, shuffle=True, num_workers=num_workers
+        self.train_loader = self._get_train_loader(
+            train_dset,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            fields=("features", "fmaps"),
         )
-        self.test_loader = DataLoader(
-            test_dset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        self.test_loader = self._loaders.get_loader(
+            "test",
+            test_dset,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
         )
 
         self._train(data_manager, self.train_loader, self.test_loader)
@@ -144,11 +151,12 @@ class PODNet(BaseLearner):
         finetune_train_dataset = data_manager.get_dataset(
             [], source="train", mode="train", appendent=self._get_memory()
         )
-        finetune_train_loader = DataLoader(
+        finetune_train_loader = self._get_train_loader(
             finetune_train_dataset,
             batch_size=batch_size,
-            shuffle=True,
             num_workers=num_workers,
+            fields=("features", "fmaps"),
+            name="finetune",
         )
         logging.info(
             "The size of finetune dataset: {}".format(len(finetune_train_dataset))
@@ -171,16 +179,11 @@ class PODNet(BaseLearner):
         self._run(finetune_train_loader, test_loader, optimizer, scheduler, ft_epochs)
 
         if self._fixed_memory:
-            self._data_memory = self._data_memory[
-                : -self._memory_per_class * self.task_size
-            ]
-            self._targets_memory = self._targets_memory[
-                : -self._memory_per_class * self.task_size
-            ]
+            self._memory.remove(np.arange(self._known_classes, self._total_classes))
             assert (
                 len(
                     np.setdiff1d(
-                        self._targets_memory, np.arange(0, self._known_classes)
+                        self._memory.targets, np.arange(0, self._known_classes)
                     )
                 )
                 == 0
@@ -193,19 +196,21 @@ class PODNet(BaseLearner):
             spatial_losses = 0.0
             flat_losses = 0.0
             correct, total = 0, 0
-            for i, (_, inputs, targets) in enumerate(train_loader):
+            for i, (idx, inputs, targets) in enumerate(train_loader):
                 inputs, targets = inputs.to(self._device), targets.to(self._device)
-                outputs = self._network(inputs)
+                outputs = self._forward(self._network, inputs)
                 logits = outputs["logits"]
                 features = outputs["features"]
                 fmaps = outputs["fmaps"]
-                lsc_loss = nca(logits, targets)
+                lsc_loss = lsc_nca(
+                    outputs["proxy_logits"], self._network.fc.sigma, targets, nb_proxy
+                )
 
                 spatial_loss = 0.0
                 flat_loss = 0.0
                 if self._old_network is not None:
                     with torch.no_grad():
-                        old_outputs = self._old_network(inputs)
+                        old_outputs = self._teacher_forward(idx, inputs)
                     old_features = old_outputs["features"]
                     old_fmaps = old_outputs["fmaps"]
                     flat_loss = (
@@ -239,17 +244,20 @@ class PODNet(BaseLearner):
             if scheduler is not None:
                 scheduler.step()
             train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
-            test_acc = self._compute_accuracy(self._network, test_loader)
+            test_acc = self._compute_epoch_accuracy(
+                self._network, test_loader, epoch - 1, epk, every=1
+            )
             info1 = "Task {}, Epoch {}/{} (LR {:.5f}) => ".format(
                 self._cur_task, epoch, epk, optimizer.param_groups[0]["lr"]
             )
-            info2 = "LSC_loss {:.2f}, Spatial_loss {:.2f}, Flat_loss {:.2f}, Train_acc {:.2f}, Test_acc {:.2f}".format(
+            info2 = "LSC_loss {:.2f}, Spatial_loss {:.2f}, Flat_loss {:.2f}, Train_acc {:.2f}".format(
                 lsc_losses / (i + 1),
                 spatial_losses / (i + 1),
                 flat_losses / (i + 1),
                 train_acc,
-                test_acc,
             )
+            if test_acc is not None:
+                info2 += ", Test_acc {:.2f}".format(test_acc)
             logging.info(info1 + info2)
 
 
@@ -257,29 +265,172 @@ def pod_spatial_loss(old_fmaps, fmaps, normalize=True):
     """
     a, b: list of [bs, c, w, h]
     """
-    loss = torch.tensor(0.0).to(fmaps[0].device)
-    for i, (a, b) in enumerate(zip(old_fmaps, fmaps)):
-        assert a.shape == b.shape, "Shape error"
+    loss = sum(
+        _PodSpatial.apply(a, b, normalize) for a, b in zip(old_fmaps, fmaps)
+    )
+    return loss / len(fmaps)
 
-        a = torch.pow(a, 2)
-        b = torch.pow(b, 2)
 
-        a_h = a.sum(dim=3).view(a.shape[0], -1)  # [bs, c*w]
-        b_h = b.sum(dim=3).view(b.shape[0], -1)  # [bs, c*w]
-        a_w = a.sum(dim=2).view(a.shape[0], -1)  # [bs, c*h]
-        b_w = b.sum(dim=2).view(b.shape[0], -1)  # [bs, c*h]
+class _PodSpatial(torch.autograd.Function):
+    """
+    POD-spatial distance of one stage, mean_i ||pool(a_i) - pool(b_i)||, where
+    pool(x) concatenates the sums of x^2 over w and over h (L2-normalized).
 
-        a = torch.cat([a_h, a_w], dim=-1)
-        b = torch.cat([b_h, b_w], dim=-1)
+    Both poolings are computed from one square of the map, and the gradient
+    2 * x * (g_w + g_h) is written in a single buffer, so neither the squared
+    maps nor the concatenated poolings are kept for backward.
+    """
 
-        if normalize:
-            a = F.normalize(a, dim=1, p=2)
-            b = F.normalize(b, dim=1, p=2)
+    @staticmethod
+    def forward(ctx, a, b, normalize):
+        assert a.shape == b.shape, "Shape error"
+        a_pools, a_norm = _pod_pools(a, normalize)
+        b_pools, b_norm = _pod_pools(b, normalize)
+        diffs = [pa - pb for pa, pb in zip(a_pools, b_pools)]
+        dists = _pod_norm(diffs)
+
+        ctx.normalize = normalize
+        ctx.save_for_backward(a, b, dists, *a_pools, *b_pools, *diffs)
+        ctx.norms = (a_norm, b_norm)
+        return dists.mean()
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        a, b, dists, *pools = ctx.saved_tensors
+        a_pools, b_pools, diffs = pools[0:2], pools[2:4], pools[4:6]
+        a_norm, b_norm = ctx.norms
+
+        # Gradient of the mean distance w.r.t. the pooling differences
+        scale = torch.where(
+            dists > 0, grad_output / (len(dists) * dists), torch.zeros_like(dists)
+        ).view(-1, 1, 1)
+        grads = [diff * scale for diff in diffs]
+
+        grad_a = grad_b = None
+        if ctx.needs_input_grad[0]:
+            grad_a = _pod_pools_backward(a, a_pools, a_norm, grads, ctx.normalize)
+        if ctx.needs_input_grad[1]:
+            grads = [-grad for grad in grads]
+            grad_b = _pod_pools_backward(b, b_pools, b_norm, grads, ctx.normalize)
+        return grad_a, grad_b, None
+
+
+def _pod_pools(x, normalize, eps=1e-12):
+    """[sum_h x^2, sum_w x^2] of x [bs, c, w, h], and their joint L2 norm if normalized."""
+    squared = x * x
+    pools = [squared.sum(dim=3), squared.sum(dim=2)]
+    del squared
+    if not normalize:
+        return pools, None
+
+    norm = _pod_norm(pools)
+    denom = norm.clamp(min=eps).view(-1, 1, 1)
+    return [pool / denom for pool in pools], norm
+
+
+def _pod_pools_backward(x, pools, norm, grads, normalize, eps=1e-12):
+    if normalize:
+        # Through pool / max(||pool||, eps), pools being already normalized
+        dot = sum((pool * grad).flatten(1).sum(dim=1) for pool, grad in zip(pools, grads))
+        dot = torch.where(norm > eps, dot, torch.zeros_like(dot)).view(-1, 1, 1)
+        denom = norm.clamp(min=eps).view(-1, 1, 1)
+        grads = [(grad - pool * dot) / denom for pool, grad in zip(pools, grads)]
+
+    grad_x = grads[0].unsqueeze(3) + grads[1].unsqueeze(2)
+    return grad_x.mul_(x).mul_(2)
+
+
+def _pod_norm(parts):
+    return sum(part.pow(2).flatten(1).sum(dim=1) for part in parts).sqrt()
+
+
+def lsc_nca(proxy_similarities, sigma, targets, nb_proxy, scale=1.0, margin=0.6):
+    """
+    nca(sigma * reduce_proxies(proxy_similarities, nb_proxy), targets) with the
+    default options, as one autograd node: the proxy reduction, the margin and
+    the logsumexp are computed together, and backward only keeps the proxy
+    similarities and per-class/per-sample vectors instead of the intermediates
+    of both. `sigma` is the learned scale of the classifier, or None.
+    """
+    bs = proxy_similarities.shape[0]
+    simi_per_class = proxy_similarities.view(bs, -1, nb_proxy)
+    if sigma is None:
+        sigma = proxy_similarities.new_ones(1)
+    return _LSCNCA.apply(simi_per_class, sigma, targets, scale, margin)
 
-        layer_loss = torch.mean(torch.frobenius_norm(a - b, dim=-1))
-        loss += layer_loss
 
-    return loss / len(fmaps)
+class _LSCNCA(torch.autograd.Function):
+    """
+    With r = sigma * sum_k softmax(s)_k s_k the reduced class scores and
+    z = scale * (r - margin), the loss of a sample of class t is
+    LSE(d) - d_t, where d = z - max(z) with d_t set to 0 inside the LSE. Its
+    gradient w.r.t. z is -(onehot_t - p' - p_t onehot_argmax), p = softmax(d)
+    and p' = p with p_t zeroed, the last term coming from the max.
+    """
+
+    @staticmethod
+    def forward(ctx, simi_per_class, sigma, targets, scale, margin):
+        dtype = torch.promote_types(simi_per_class.dtype, torch.float32)
+        simi = simi_per_class.to(dtype)
+        shift = simi.amax(dim=-1, keepdim=True)
+        exps = (simi - shift).exp_()
+        norm = exps.sum(-1)
+        reduced = (exps * simi).sum(-1).div_(norm)  # [bs, nb_classes]
+        del exps
+
+        z = scale * (sigma.to(reduced.dtype) * reduced - margin)
+        z_max, argmax = z.max(dim=1)
+        index = targets.view(-1, 1)
+        d = (z - z_max.unsqueeze(1)).scatter_(1, index, 0.0)
+        lse = torch.logsumexp(d, dim=1)
+        numerator = z.gather(1, index).squeeze(1) - z_max
+        loss = (lse - numerator).mean()
+
+        ctx.scale, ctx.margin = scale, margin
+        ctx.save_for_backward(
+            simi_per_class, sigma, targets, shift, norm, reduced, z_max, argmax, lse
+        )
+        return loss
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        (
+            simi_per_class,
+            sigma,
+            targets,
+            shift,
+            norm,
+            reduced,
+            z_max,
+            argmax,
+            lse,
+        ) = ctx.saved_tensors
+        scale, bs = ctx.scale, len(targets)
+        index = targets.view(-1, 1)
+
+        # Gradient w.r.t. z
+        z = scale * (sigma.to(reduced.dtype) * reduced - ctx.margin)
+        d = (z - z_max.unsqueeze(1)).scatter_(1, index, 0.0)
+        probs = (d - lse.unsqueeze(1)).exp_()
+        p_target = probs.gather(1, index)
+        grad_z = probs.scatter_(1, index, -1.0)
+        grad_z.scatter_add_(1, argmax.view(-1, 1), p_target)
+        grad_z.mul_(grad_output.to(grad_z.dtype) / bs)
+
+        grad_sigma = None
+        if ctx.needs_input_grad[1]:
+            grad_sigma = scale * (grad_z * reduced).sum()
+            grad_sigma = grad_sigma.to(sigma.dtype).view_as(sigma)
+
+        # Through the proxy reduction, d r / d s_k = softmax(s)_k * (1 + s_k - r)
+        grad_reduced = grad_z.mul_(scale * sigma.to(grad_z.dtype))
+        simi = simi_per_class.to(grad_reduced.dtype)
+        grad = (simi - shift).exp_()
+        grad.mul_((grad_reduced / norm).unsqueeze(-1))
+        grad.mul_(simi - (reduced - 1).unsqueeze(-1))
+        return grad.to(simi_per_class.dtype), grad_sigma, None, None, None
 
 
 def nca(
@@ -293,22 +444,17 @@ def nca(
     hinge_proxynca=False,
     memory_flags=None,
 ):
-    margins = torch.zeros_like(similarities)
-    margins[torch.arange(margins.shape[0]), targets] = margin
     similarities = scale * (similarities - margin)
 
     if exclude_pos_denominator:
-        similarities = similarities - similarities.max(1)[0].view(-1, 1)
-
-        disable_pos = torch.zeros_like(similarities)
-        disable_pos[torch.arange(len(similarities)), targets] = similarities[
-            torch.arange(len(similarities)), targets
-        ]
+        similarities = similarities - similarities.max(1, keepdim=True)[0]
 
-        numerator = similarities[torch.arange(similarities.shape[0]), targets]
-        denominator = similarities - disable_pos
+        # The positive stays in the denominator as exp(0)
+        index = targets.view(-1, 1)
+        numerator = similarities.gather(1, index).squeeze(1)
+        denominator = similarities.scatter(1, index, 0.0)
 
-        losses = numerator - torch.log(torch.exp(denominator).sum(-1))
+        losses = numerator - torch.logsumexp(denominator, dim=-1)
         if class_weights is not None:
             losses = class_weights[targets] * losses
 
@@ -4,7 +4,6 @@ import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
 from models.foster import FOSTER
 from utils.toolkit import count_parameters, tensor2numpy, accuracy
 from utils.inc_net import IncrementalNet
@@ -85,14 +84,18 @@ class RMMBase(BaseLearner):
                 mode="test",
                 ret_data=True,
             )
-            idx_loader = DataLoader(
-                idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4
+            idx_loader = self._loaders.get_loader(
+                "features",
+                idx_dataset,
+                batch_size=batch_size,
+                shuffle=False,
+                num_workers=4,
             )
             with torch.no_grad():
                 cidx_cls_entropies = []
                 for idx, (_, inputs, targets) in enumerate(idx_loader):
                     inputs, targets = inputs.to(self._device), targets.to(self._device)
-                    logits = self._network(inputs)["logits"]
+                    logits = self._forward(self._network, inputs)["logits"]
                     cross_entropy = (
                         F.cross_entropy(logits, targets, reduction="none")
                         .detach()
@@ -111,74 +114,14 @@ class RMMBase(BaseLearner):
                 ms.append(ns[1])
 
         logging.info(f"ms: {ms}")
-        for class_idx in range(self._known_classes, self._total_classes):
-            data, targets, idx_dataset = data_manager.get_dataset(
-                np.arange(class_idx, class_idx + 1),
-                source="train",
-                mode="test",
-                ret_data=True,
-            )
-            idx_loader = DataLoader(
-                idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4
-            )
-            vectors, _ = self._extract_vectors(idx_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            class_mean = np.mean(vectors, axis=0)
-            # Select
-            selected_exemplars = []
-            exemplar_vectors = []  # [n, feature_dim]
-            for k in range(1, ms[class_idx - self._known_classes] + 1):
-                S = np.sum(
-                    exemplar_vectors, axis=0
-                )  # [feature_dim] sum of selected exemplars vectors
-                mu_p = (vectors + S) / k  # [n, feature_dim] sum to all vectors
-                i = np.argmin(np.sqrt(np.sum((class_mean - mu_p) ** 2, axis=1)))
-                selected_exemplars.append(
-                    np.array(data[i])
-                )  # New object to avoid passing by inference
-                exemplar_vectors.append(
-                    np.array(vectors[i])
-                )  # New object to avoid passing by inference
+        selected, exemplar_targets = self._select_new_exemplars(data_manager, ms)
+        self._memory.extend(selected, exemplar_targets, data_manager)
 
-                vectors = np.delete(
-                    vectors, i, axis=0
-                )  # Remove it to avoid duplicative selection
-                data = np.delete(
-                    data, i, axis=0
-                )  # Remove it to avoid duplicative selection
-                if len(vectors) == 0:
-                    break
-                
-            selected_exemplars = np.array(selected_exemplars)
-            # exemplar_targets = np.full(ms[class_idx - self._known_classes], class_idx)
-            exemplar_targets = np.full(selected_exemplars.shape[0], class_idx)
-            self._data_memory = (
-                np.concatenate((self._data_memory, selected_exemplars))
-                if len(self._data_memory) != 0
-                else selected_exemplars
-            )
-            self._targets_memory = (
-                np.concatenate((self._targets_memory, exemplar_targets))
-                if len(self._targets_memory) != 0
-                else exemplar_targets
-            )
+        # Exemplar mean, the selected samples were already embedded above
+        vectors = self._extract_cached_vectors(data_manager, selected)
+        classes, means = self._compute_class_means(vectors, exemplar_targets)
 
-            # Exemplar mean
-            idx_dataset = data_manager.get_dataset(
-                [],
-                source="train",
-                mode="test",
-                appendent=(selected_exemplars, exemplar_targets),
-            )
-            idx_loader = DataLoader(
-                idx_dataset, batch_size=batch_size, shuffle=False, num_workers=4
-            )
-            vectors, _ = self._extract_vectors(idx_loader)
-            vectors = (vectors.T / (np.linalg.norm(vectors.T, axis=0) + EPSILON)).T
-            mean = np.mean(vectors, axis=0)
-            mean = mean / np.linalg.norm(mean)
-
-            self._class_means[class_idx, :] = mean
+        self._class_means[classes, :] = means
 
 
 class RMM_iCaRL(
@@ -205,7 +148,8 @@ class RMM_iCaRL(
             appendent=self._get_memory(),
             m_rate=self._m_rate_list[self._cur_task] if self._cur_task > 0 else None,
         )
-        self.train_loader = DataLoader(
+        self.train_loader = self._loaders.get_loader(
+            "train",
             train_dataset,
             batch_size=batch_size,
             shuffle=True,
@@ -215,8 +159,12 @@ class RMM_iCaRL(
         test_dataset = data_manager.get_dataset(
             np.arange(0, self._total_classes), source="test", mode="test"
         )
-        self.test_loader = DataLoader(
-            test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        self.test_loader = self._loaders.get_loader(
+            "test",
+            test_dataset,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
         )
         if len(self._multiple_gpus) > 1:
             self._network = nn.DataParallel(self._network, self._multiple_gpus)
@@ -263,7 +211,8 @@ class RMM_FOSTER(RMMBase, FOSTER):
             appendent=self._get_memory(),
             m_rate=self._m_rate_list[self._cur_task] if self._cur_task > 0 else None,
         )
-        self.train_loader = DataLoader(
+        self.train_loader = self._loaders.get_loader(
+            "train",
             train_dataset,
             batch_size=self.args["batch_size"],
             shuffle=True,
@@ -273,7 +222,8 @@ class RMM_FOSTER(RMMBase, FOSTER):
         test_dataset = data_manager.get_dataset(
             np.arange(0, self._total_classes), source="test", mode="test"
         )
-        self.test_loader = DataLoader(
+        self.test_loader = self._loaders.get_loader(
+            "test",
             test_dataset,
             batch_size=self.args["batch_size"],
             shuffle=False,
@@ -71,6 +71,8 @@ class CILEnv:
         cnn_accy, nme_accy = self.model.eval_task()
         self.model.after_task()
         done = self.cur_task == self.nb_task - 1
+        if done:
+            self.model.close()
         info = "running task [{}/{}]:  dataset: {}, increment: {}, cnn_accy top1: {},  top5: {}".format(
             self.model._known_classes,
             100,
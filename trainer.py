@@ -87,6 +87,11 @@ def _train(args):
         args["seed"],
         args["init_cls"],
         args["increment"],
+        batch_aug=args.get("batch_aug", False),
+        batch_aug_device=args["device"][0] if args.get("batch_aug_on_device", False) else None,
+        image_cache_bytes=int(args.get("image_cache_mb", 0) * 2 ** 20),
+        image_cache_resize=args.get("image_cache_resize", None),
+        test_cache=args.get("test_cache", False),
     )
     model = factory.get_model(args["model_name"], args)
 
@@ -132,6 +137,7 @@ def _train(args):
             logging.info("CNN top1 curve: {}".format(cnn_curve["top1"]))
             logging.info("CNN top5 curve: {}\n".format(cnn_curve["top5"]))
     
+    model.close()
     end_time = time.time()
     logging.info(f"End Time:{end_time}")
     cost_time = end_time - start_time
@@ -0,0 +1,154 @@
+import copy
+import itertools
+import logging
+import queue
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch import nn
+from torch.utils.data import DataLoader
+from utils.loader_factory import SwappableDataset
+
+
+class AsyncEvaluator(object):
+    """
+    Test accuracy of weight snapshots, computed in a background process on
+    `device` (e.g. "cpu" or a spare "cuda:1") while training goes on.
+
+    At most one snapshot is in flight: a snapshot submitted while the previous
+    one is still being evaluated is dropped, so a slow evaluator never queues up
+    model copies. Results are logged as they come in, see poll() and wait().
+    """
+
+    def __init__(self, device="cpu", batch_size=128):
+        self.device = device
+        self.batch_size = batch_size
+        self._process = None
+        self._jobs = None
+        self._results = None
+        self._dataset = None  # last dataset sent to the worker
+        self._signature = None  # architecture of the last model sent to the worker
+        self._pending = 0
+
+    def submit(self, tag, model, loader):
+        """Queues an evaluation of model on the dataset of loader, returns False if busy."""
+        self.poll()
+        if self._pending > 0:
+            return False
+        if self._process is None:
+            self._start()
+
+        if isinstance(model, nn.DataParallel):
+            model = model.module
+        # Only a CPU copy of the weights, plus the module structure when it changed
+        state = {
+            k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()
+        }
+        signature = (type(model), tuple((k, tuple(v.shape)) for k, v in state.items()))
+        skeleton = None
+        if signature != self._signature:
+            skeleton = _cpu_skeleton(model)
+        dataset = loader.dataset
+        if isinstance(dataset, SwappableDataset):
+            dataset = dataset.dataset
+        new_dataset = None
+        if dataset is not self._dataset:
+            new_dataset = dataset
+            if getattr(dataset, "device", None) is not None:
+                # Batches go to the evaluator's device, not the training one
+                new_dataset = copy.copy(dataset)
+                new_dataset.device = None
+        self._jobs.put((tag, state, skeleton, new_dataset))
+        self._dataset = dataset
+        self._signature = signature
+        self._pending += 1
+        return True
+
+    def poll(self):
+        """Logs the results that are ready, without waiting."""
+        while self._pending > 0:
+            try:
+                result = self._results.get_nowait()
+            except queue.Empty:
+                return
+            self._log(result)
+
+    def wait(self):
+        """Logs the results of all submitted snapshots."""
+        while self._pending > 0:
+            self._log(self._results.get())
+
+    def close(self):
+        if self._process is not None:
+            self._jobs.put(None)
+            self._process.join()
+            self._process = None
+            self._dataset, self._signature = None, None
+
+    def _start(self):
+        # CUDA cannot be used in a forked child
+        ctx = mp.get_context("spawn")
+        self._jobs = ctx.Queue()
+        self._results = ctx.Queue()
+        self._process = ctx.Process(
+            target=_worker,
+            args=(self._jobs, self._results, self.device, self.batch_size),
+            daemon=True,
+        )
+        self._process.start()
+
+    def _log(self, result):
+        self._pending -= 1
+        tag, test_acc, error = result
+        if error is not None:
+            logging.warning("{} => async evaluation failed: {}".format(tag, error))
+        else:
+            logging.info("{} => Test_accy {:.2f} (async)".format(tag, test_acc))
+
+
+def _worker(jobs, results, device, batch_size):
+    device = torch.device(device)
+    model, dataset = None, None
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        tag, state, skeleton, new_dataset = job
+        if skeleton is not None:
+            model = skeleton.to(device)
+        if new_dataset is not None:
+            dataset = new_dataset
+        try:
+            model.load_state_dict(state)
+            test_acc = _compute_accuracy(model, dataset, device, batch_size)
+            results.put((tag, test_acc, None))
+        except Exception as e:
+            results.put((tag, None, repr(e)))
+
+
+def _cpu_skeleton(model):
+    """Copy of model with empty CPU tensors, without copying its weights."""
+    memo = {}
+    for tensor in itertools.chain(model.parameters(), model.buffers()):
+        empty = torch.empty(tensor.shape, dtype=tensor.dtype)
+        if isinstance(tensor, nn.Parameter):
+            empty = nn.Parameter(empty, requires_grad=tensor.requires_grad)
+        memo[id(tensor)] = empty
+    return copy.deepcopy(model, memo)
+
+
+def _compute_accuracy(model, dataset, device, batch_size):
+    if getattr(dataset, "preloaded", False):
+        loader = dataset.get_loader(batch_size)
+    else:
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    model.eval()
+    correct, total = 0, 0
+    for _, inputs, targets in loader:
+        with torch.no_grad():
+            outputs = model(inputs.to(device))["logits"]
+        predicts = torch.max(outputs, dim=1)[1]
+        correct += (predicts.cpu() == targets).sum().item()
+        total += len(targets)
+
+    return np.around(correct * 100 / total, decimals=2)
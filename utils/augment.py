@@ -0,0 +1,134 @@
+"""
+Batched counterparts of the torchvision transforms used by the in-memory
+datasets. They work on float tensors of shape [bs, c, h, w] with values in
+[0, 1] (see `to_float_batch`), draw their randomness from the torch RNG
+exactly like the torchvision transforms do, and run on whatever device the
+batch lives on.
+"""
+import math
+import torch
+from torch.nn import functional as F
+
+
+def to_float_batch(images):
+    """uint8 [bs, h, w, c] -> float [bs, c, h, w] in [0, 1], i.e. a batched ToTensor."""
+    return images.permute(0, 3, 1, 2).float().div_(255)
+
+
+class BatchCompose(object):
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, x):
+        for t in self.transforms:
+            x = t(x)
+        return x
+
+
+class BatchRandomCrop(object):
+    def __init__(self, size, padding=0):
+        self.size = size
+        self.padding = padding
+
+    def __call__(self, x):
+        if self.padding > 0:
+            x = F.pad(x, [self.padding] * 4)
+        bs, c, h, w = x.shape
+        if h == self.size and w == self.size:
+            return x
+
+        top = torch.randint(0, h - self.size + 1, (bs,)).to(x.device)
+        left = torch.randint(0, w - self.size + 1, (bs,)).to(x.device)
+        offsets = torch.arange(self.size, device=x.device)
+        rows = (top[:, None] + offsets)[:, None, :, None]  # [bs, 1, size, 1]
+        cols = (left[:, None] + offsets)[:, None, None, :]  # [bs, 1, 1, size]
+        batch = torch.arange(bs, device=x.device)[:, None, None, None]
+        channels = torch.arange(c, device=x.device)[None, :, None, None]
+
+        return x[batch, channels, rows, cols]
+
+
+class BatchCenterCrop(object):
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, x):
+        h, w = x.shape[-2:]
+        top, left = (h - self.size) // 2, (w - self.size) // 2
+        return x[..., top : top + self.size, left : left + self.size]
+
+
+class BatchRandomResizedCrop(object):
+    """
+    Crop boxes drawn per sample like torchvision's RandomResizedCrop (10
+    attempts, then the whole image), resampled to `size` bilinearly with one
+    grid_sample over the batch (no antialiasing when shrinking).
+    """
+
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3 / 4, 4 / 3), attempts=10):
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.attempts = attempts
+
+    def __call__(self, x):
+        bs, c, h, w = x.shape
+        area = h * w * torch.empty(bs, self.attempts).uniform_(*self.scale)
+        log_ratio = torch.empty(bs, self.attempts).uniform_(
+            math.log(self.ratio[0]), math.log(self.ratio[1])
+        )
+        crop_w = (area * log_ratio.exp()).sqrt().round()
+        crop_h = (area / log_ratio.exp()).sqrt().round()
+        valid = (crop_w > 0) & (crop_w <= w) & (crop_h > 0) & (crop_h <= h)
+        # First valid attempt of each sample, the whole image if there is none
+        rows, first = torch.arange(bs), valid.float().argmax(dim=1)
+        found = valid.any(dim=1)
+        crop_w = crop_w[rows, first].where(found, torch.tensor(float(w)))
+        crop_h = crop_h[rows, first].where(found, torch.tensor(float(h)))
+        left = (torch.rand(bs) * (w - crop_w + 1)).floor()
+        top = (torch.rand(bs) * (h - crop_h + 1)).floor()
+
+        # The box in grid_sample coordinates, [-1, 1] over the image borders
+        theta = torch.zeros(bs, 2, 3)
+        theta[:, 0, 0] = crop_w / w
+        theta[:, 1, 1] = crop_h / h
+        theta[:, 0, 2] = (2 * left + crop_w) / w - 1
+        theta[:, 1, 2] = (2 * top + crop_h) / h - 1
+        grid = F.affine_grid(
+            theta.to(x.device), [bs, c, self.size, self.size], align_corners=False
+        )
+        return F.grid_sample(
+            x, grid, mode="bilinear", padding_mode="border", align_corners=False
+        )
+
+
+class BatchRandomHorizontalFlip(object):
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, x):
+        if self.p >= 1.0:
+            return x.flip(-1)
+        flip = (torch.rand(x.shape[0]) < self.p).to(x.device)
+        return torch.where(flip[:, None, None, None], x.flip(-1), x)
+
+
+class BatchColorJitter(object):
+    """Only the brightness jitter, which is all the CIL configs use."""
+
+    def __init__(self, brightness=0.0):
+        self.brightness = (max(0.0, 1.0 - brightness), 1.0 + brightness)
+
+    def __call__(self, x):
+        low, high = self.brightness
+        factor = torch.empty(x.shape[0]).uniform_(low, high).to(x.device)
+        return (x * factor[:, None, None, None]).clamp_(0.0, 1.0)
+
+
+class BatchNormalize(object):
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean)[:, None, None]
+        self.std = torch.tensor(std)[:, None, None]
+
+    def __call__(self, x):
+        return (x - self.mean.to(x.device)) / self.std.to(x.device)
@@ -0,0 +1,27 @@
+import torch
+
+
+class ClassFeatureStats(object):
+    """
+    Running per-class sums and counts of features, kept on `device` and fed
+    with the features that a training loop computes anyway.
+    """
+
+    def __init__(self, nb_classes, feature_dim, device):
+        self.sums = torch.zeros(nb_classes, feature_dim, device=device)
+        self.counts = torch.zeros(nb_classes, device=device)
+
+    def update(self, features, targets):
+        self.sums.index_add_(0, targets, features.detach().to(self.sums.dtype))
+        self.counts.index_add_(0, targets, self.counts.new_ones(len(targets)))
+
+    def reset(self):
+        self.sums.zero_()
+        self.counts.zero_()
+
+    def means(self, previous=None):
+        """Class means; classes without features so far get `previous` (or zeros)."""
+        means = self.sums / self.counts.clamp(min=1).unsqueeze(1)
+        if previous is not None:
+            means = torch.where(self.counts.unsqueeze(1) > 0, means, previous)
+        return means
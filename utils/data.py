@@ -1,6 +1,15 @@
 import numpy as np
 from torchvision import datasets, transforms
 from utils.toolkit import split_images_labels
+from utils.shard import load_shard
+from utils.augment import (
+    BatchCenterCrop,
+    BatchColorJitter,
+    BatchNormalize,
+    BatchRandomCrop,
+    BatchRandomHorizontalFlip,
+    BatchRandomResizedCrop,
+)
 
 
 class iData(object):
@@ -8,6 +17,16 @@ class iData(object):
     test_trsf = []
     common_trsf = []
     class_order = None
+    # Maps an entry of train_data/test_data to a PIL image when use_path is set
+    # (None -> the entries are file paths)
+    loader = None
+    # Batched equivalents of the transforms above, for tensor-resident datasets
+    batch_train_trsf = None
+    batch_test_trsf = None
+    batch_common_trsf = None
+    # use_path: side of the square uint8 images that the batched transforms
+    # start from (resized short side, then center crop)
+    batch_image_size = None
 
 
 class iCIFAR10(iData):
@@ -24,6 +43,15 @@ class iCIFAR10(iData):
             mean=(0.4914, 0.4822, 0.4465), std=(0.2023, 0.1994, 0.2010)
         ),
     ]
+    batch_train_trsf = [
+        BatchRandomCrop(32, padding=4),
+        BatchRandomHorizontalFlip(p=0.5),
+        BatchColorJitter(brightness=63 / 255),
+    ]
+    batch_test_trsf = []
+    batch_common_trsf = [
+        BatchNormalize(mean=(0.4914, 0.4822, 0.4465), std=(0.2023, 0.1994, 0.2010)),
+    ]
 
     class_order = np.arange(10).tolist()
 
@@ -52,6 +80,15 @@ class iCIFAR100(iData):
             mean=(0.5071, 0.4867, 0.4408), std=(0.2675, 0.2565, 0.2761)
         ),
     ]
+    batch_train_trsf = [
+        BatchRandomCrop(32, padding=4),
+        BatchRandomHorizontalFlip(),
+        BatchColorJitter(brightness=63 / 255),
+    ]
+    batch_test_trsf = []
+    batch_common_trsf = [
+        BatchNormalize(mean=(0.5071, 0.4867, 0.4408), std=(0.2675, 0.2565, 0.2761)),
+    ]
 
     class_order = np.arange(100).tolist()
 
@@ -81,6 +118,18 @@ class iImageNet1000(iData):
         transforms.ToTensor(),
         transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
     ]
+    batch_image_size = 256
+    batch_train_trsf = [
+        BatchRandomResizedCrop(224),
+        BatchRandomHorizontalFlip(),
+        BatchColorJitter(brightness=63 / 255),
+    ]
+    batch_test_trsf = [
+        BatchCenterCrop(224),
+    ]
+    batch_common_trsf = [
+        BatchNormalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),
+    ]
 
     class_order = np.arange(1000).tolist()
 
@@ -110,6 +159,17 @@ class iImageNet100(iData):
         transforms.ToTensor(),
         transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
     ]
+    batch_image_size = 256
+    batch_train_trsf = [
+        BatchRandomResizedCrop(224),
+        BatchRandomHorizontalFlip(),
+    ]
+    batch_test_trsf = [
+        BatchCenterCrop(224),
+    ]
+    batch_common_trsf = [
+        BatchNormalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),
+    ]
 
     class_order = np.arange(1000).tolist()
 
@@ -123,3 +183,27 @@ class iImageNet100(iData):
 
         self.train_data, self.train_targets = split_images_labels(train_dset.imgs)
         self.test_data, self.test_targets = split_images_labels(test_dset.imgs)
+
+
+class iImageNet1000Shard(iImageNet1000):
+    """iImageNet1000 read from a shard written by build_shard.py."""
+
+    def download_data(self):
+        assert 0, "You should specify the prefix of your shard"
+        shard_prefix = "[SHARD-PATH]/imagenet1000"
+
+        self.loader, splits = load_shard(shard_prefix)
+        self.train_data, self.train_targets = splits["train"]
+        self.test_data, self.test_targets = splits["val"]
+
+
+class iImageNet100Shard(iImageNet100):
+    """iImageNet100 read from a shard written by build_shard.py."""
+
+    def download_data(self):
+        assert 0, "You should specify the prefix of your shard"
+        shard_prefix = "[SHARD-PATH]/imagenet100"
+
+        self.loader, splits = load_shard(shard_prefix)
+        self.train_data, self.train_targets = splits["train"]
+        self.test_data, self.test_targets = splits["val"]
@@ -1,15 +1,43 @@
 import logging
 import numpy as np
+import torch
 from PIL import Image
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
 from torchvision import transforms
-from utils.data import iCIFAR10, iCIFAR100, iImageNet100, iImageNet1000
+from utils.augment import BatchCompose, BatchRandomHorizontalFlip, to_float_batch
+from utils.image_cache import get_image_cache
+from utils.test_cache import PreloadedDataset, TestTensorCache
+from utils.data import (
+    iCIFAR10,
+    iCIFAR100,
+    iImageNet100,
+    iImageNet1000,
+    iImageNet100Shard,
+    iImageNet1000Shard,
+)
 
 
 class DataManager(object):
-    def __init__(self, dataset_name, shuffle, seed, init_cls, increment):
+    def __init__(
+        self,
+        dataset_name,
+        shuffle,
+        seed,
+        init_cls,
+        increment,
+        batch_aug=False,
+        batch_aug_device=None,
+        image_cache_bytes=0,
+        image_cache_resize=None,
+        test_cache=False,
+    ):
         self.dataset_name = dataset_name
         self._setup_data(dataset_name, shuffle, seed)
+        self._setup_batch_aug(batch_aug, batch_aug_device)
+        self._setup_image_cache(image_cache_bytes, image_cache_resize)
+        self._test_cache = None
+        if test_cache:
+            self._test_cache = TestTensorCache(self._test_trsf, self._common_trsf)
         assert init_cls <= len(self._class_order), "No enough classes."
         self._increments = [init_cls]
         while sum(self._increments) + increment < len(self._class_order):
@@ -31,76 +59,192 @@ class DataManager(object):
     def get_dataset(
         self, indices, source, mode, appendent=None, ret_data=False, m_rate=None
     ):
-        if source == "train":
-            x, y = self._train_data, self._train_targets
-        elif source == "test":
-            x, y = self._test_data, self._test_targets
+        if (
+            self._test_cache is not None
+            and (source, mode) == ("test", "test")
+            and appendent is None
+            and m_rate is None
+            and not ret_data
+        ):
+            return self._get_cached_test_dataset(indices)
+
+        x, y = self._get_source(source)
+
+        if m_rate is None:
+            positions = self.get_positions(indices, source)
         else:
-            raise ValueError("Unknown data source {}.".format(source))
-
-        if mode == "train":
-            trsf = transforms.Compose([*self._train_trsf, *self._common_trsf])
-        elif mode == "flip":
-            trsf = transforms.Compose(
-                [
-                    *self._test_trsf,
-                    transforms.RandomHorizontalFlip(p=1.0),
-                    *self._common_trsf,
-                ]
-            )
-        elif mode == "test":
-            trsf = transforms.Compose([*self._test_trsf, *self._common_trsf])
-        else:
-            raise ValueError("Unknown mode {}.".format(mode))
-
-        data, targets = [], []
-        for idx in indices:
-            if m_rate is None:
-                class_data, class_targets = self._select(
-                    x, y, low_range=idx, high_range=idx + 1
-                )
-            else:
-                class_data, class_targets = self._select_rmm(
-                    x, y, low_range=idx, high_range=idx + 1, m_rate=m_rate
-                )
-            data.append(class_data)
-            targets.append(class_targets)
+            positions = self._select_rmm(indices, source, m_rate=m_rate)
+        data, targets = [x[positions]], [y[positions]]
 
         if appendent is not None and len(appendent) != 0:
             appendent_data, appendent_targets = appendent
             data.append(appendent_data)
             targets.append(appendent_targets)
 
+        # Only the memory samples (the appendent) go through the image cache
+        cached = np.arange(sum(len(d) for d in data)) >= len(data[0])
         data, targets = np.concatenate(data), np.concatenate(targets)
 
         if ret_data:
-            return data, targets, DummyDataset(data, targets, trsf, self.use_path)
+            return data, targets, self._build_dataset(data, targets, mode, cached)
         else:
-            return DummyDataset(data, targets, trsf, self.use_path)
+            return self._build_dataset(data, targets, mode, cached)
+
+    def get_positions(self, indices, source):
+        """
+        Positions in the `source` split of the samples of classes `indices`,
+        in the same order as get_dataset() yields them.
+        """
+        positions, offsets = self._get_class_index(source)
+        if len(indices) == 0:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(
+            [positions[offsets[idx] : offsets[idx + 1]] for idx in indices]
+        )
 
-    def get_dataset_with_split(
-        self, indices, source, mode, appendent=None, val_samples_per_class=0
-    ):
+    def get_data(self, positions, source):
+        x, y = self._get_source(source)
+        return x[positions], y[positions]
+
+    def get_dataset_by_positions(self, positions, source, mode, cached=None):
+        """`cached`: optional mask of the positions to read through the image cache."""
+        data, targets = self.get_data(positions, source)
+        return self._build_dataset(data, targets, mode, cached)
+
+    def get_memory_dataset(self, appendent, mode="train", device=None):
+        """
+        Dataset of the memory samples alone, for learners that draw batches from
+        it directly. Path-based datasets decode the samples once, into uint8
+        images of batch_image_size (see _decode_memory), and so do in-memory
+        ones with "batch_aug": these keep the samples as one uint8 tensor on
+        `device` and augment every drawn batch there (see
+        TensorDummyDataset.get_batch). The others get the per-sample transforms.
+        """
+        data, targets = appendent
+        if self._batch_train_trsf is None or not (self.use_path or self._batch_aug):
+            return self._build_dataset(
+                data, targets, mode, cached=np.ones(len(data), dtype=bool)
+            )
+        if self.use_path:
+            data = self._decode_memory(data)
+        return TensorDummyDataset(
+            data, targets, self._get_batch_trsf(mode), device, resident=True
+        )
+
+    def _decode_memory(self, data):
+        """
+        uint8 [n, size, size, 3] images of the paths (or shard entries) `data`:
+        short side resized to size, then center cropped. The batched random
+        crops of the memory are thus drawn from that center square.
+        """
+        size = self._batch_image_size
+        trsf = transforms.Compose([transforms.Resize(size), transforms.CenterCrop(size)])
+        images = np.empty((len(data), size, size, 3), dtype=np.uint8)
+        for i, d in enumerate(data):
+            images[i] = np.asarray(trsf(self._load_image(d)))
+        return images
+
+    def _get_cached_test_dataset(self, indices):
+        """
+        The test transform is deterministic, so every test image is decoded and
+        transformed once per run; later tasks only transform their new classes.
+        """
+        for idx in indices:
+            if idx not in self._test_cache:
+                data, _ = self.get_data(self.get_positions([idx], "test"), "test")
+                self._test_cache.append(idx, [self._load_image(d) for d in data])
+
+        positions = self.get_positions(indices, "test")
+        return PreloadedDataset(
+            self._test_cache.get(indices),
+            self._test_targets[positions],
+            self._test_cache.normalize,
+        )
+
+    def _load_image(self, data):
+        if self.use_path:
+            return (pil_loader if self._loader is None else self._loader)(data)
+        return Image.fromarray(data)
+
+    def _get_source(self, source):
+        if source == "train":
+            return self._train_data, self._train_targets
+        elif source == "test":
+            return self._test_data, self._test_targets
+        else:
+            raise ValueError("Unknown data source {}.".format(source))
+
+    def _get_class_index(self, source):
         if source == "train":
-            x, y = self._train_data, self._train_targets
+            return self._train_class_index
         elif source == "test":
-            x, y = self._test_data, self._test_targets
+            return self._test_class_index
         else:
             raise ValueError("Unknown data source {}.".format(source))
 
+    def _build_dataset(self, data, targets, mode, cached=None):
+        if self._batch_aug:
+            return TensorDummyDataset(
+                data, targets, self._get_batch_trsf(mode), self._batch_aug_device
+            )
+        if self._image_cache is None or cached is None or not cached.any():
+            return DummyDataset(
+                data, targets, self._get_trsf(mode), self.use_path, self._loader
+            )
+        return DummyDataset(
+            data,
+            targets,
+            self._get_trsf(mode),
+            self.use_path,
+            self._loader,
+            image_cache=self._image_cache,
+            cached=cached,
+        )
+
+    def _get_batch_trsf(self, mode):
         if mode == "train":
-            trsf = transforms.Compose([*self._train_trsf, *self._common_trsf])
+            return BatchCompose([*self._batch_train_trsf, *self._batch_common_trsf])
+        elif mode == "flip":
+            return BatchCompose(
+                [
+                    *self._batch_test_trsf,
+                    BatchRandomHorizontalFlip(p=1.0),
+                    *self._batch_common_trsf,
+                ]
+            )
         elif mode == "test":
-            trsf = transforms.Compose([*self._test_trsf, *self._common_trsf])
+            return BatchCompose([*self._batch_test_trsf, *self._batch_common_trsf])
         else:
             raise ValueError("Unknown mode {}.".format(mode))
 
+    def _get_trsf(self, mode):
+        if mode == "train":
+            return transforms.Compose([*self._train_trsf, *self._common_trsf])
+        elif mode == "flip":
+            return transforms.Compose(
+                [
+                    *self._test_trsf,
+                    transforms.RandomHorizontalFlip(p=1.0),
+                    *self._common_trsf,
+                ]
+            )
+        elif mode == "test":
+            return transforms.Compose([*self._test_trsf, *self._common_trsf])
+        else:
+            raise ValueError("Unknown mode {}.".format(mode))
+
+    def get_dataset_with_split(
+        self, indices, source, mode, appendent=None, val_samples_per_class=0
+    ):
+        x, y = self._get_source(source)
+        if mode not in ("train", "test"):
+            raise ValueError("Unknown mode {}.".format(mode))
+
         train_data, train_targets = [], []
         val_data, val_targets = [], []
         for idx in indices:
-            class_data, class_targets = self._select(
-                x, y, low_range=idx, high_range=idx + 1
-            )
+            class_positions = self.get_positions([idx], source)
+            class_data, class_targets = x[class_positions], y[class_positions]
             val_indx = np.random.choice(
                 len(class_data), val_samples_per_class, replace=False
             )
@@ -109,6 +253,7 @@ class DataManager(object):
             val_targets.append(class_targets[val_indx])
             train_data.append(class_data[train_indx])
             train_targets.append(class_targets[train_indx])
+        nb_new_train, nb_new_val = sum(map(len, train_data)), sum(map(len, val_data))
 
         if appendent is not None:
             appendent_data, appendent_targets = appendent
@@ -130,9 +275,11 @@ class DataManager(object):
         )
         val_data, val_targets = np.concatenate(val_data), np.concatenate(val_targets)
 
-        return DummyDataset(
-            train_data, train_targets, trsf, self.use_path
-        ), DummyDataset(val_data, val_targets, trsf, self.use_path)
+        return self._build_dataset(
+            train_data, train_targets, mode, np.arange(len(train_data)) >= nb_new_train
+        ), self._build_dataset(
+            val_data, val_targets, mode, np.arange(len(val_data)) >= nb_new_val
+        )
 
     def _setup_data(self, dataset_name, shuffle, seed):
         idata = _get_idata(dataset_name)
@@ -142,11 +289,16 @@ class DataManager(object):
         self._train_data, self._train_targets = idata.train_data, idata.train_targets
         self._test_data, self._test_targets = idata.test_data, idata.test_targets
         self.use_path = idata.use_path
+        self._loader = idata.loader
 
         # Transforms
         self._train_trsf = idata.train_trsf
         self._test_trsf = idata.test_trsf
         self._common_trsf = idata.common_trsf
+        self._batch_train_trsf = idata.batch_train_trsf
+        self._batch_test_trsf = idata.batch_test_trsf
+        self._batch_common_trsf = idata.batch_common_trsf
+        self._batch_image_size = idata.batch_image_size
 
         # Order
         order = [i for i in range(len(np.unique(self._train_targets)))]
@@ -164,22 +316,48 @@ class DataManager(object):
         )
         self._test_targets = _map_new_class_index(self._test_targets, self._class_order)
 
+        # Class -> positions tables
+        self._train_class_index = _build_class_index(
+            self._train_targets, len(self._class_order)
+        )
+        self._test_class_index = _build_class_index(
+            self._test_targets, len(self._class_order)
+        )
+
+    def _setup_batch_aug(self, batch_aug, batch_aug_device):
+        if batch_aug and (self.use_path or self._batch_train_trsf is None):
+            logging.warning(
+                "Batched augmentation is not available for {}, using the per-sample transforms.".format(
+                    self.dataset_name
+                )
+            )
+            batch_aug = False
+        self._batch_aug = batch_aug
+        self._batch_aug_device = batch_aug_device
+
+    def _setup_image_cache(self, image_cache_bytes, image_cache_resize):
+        # Decoded memory samples of path-based datasets, see utils/image_cache.py
+        if image_cache_bytes > 0 and self.use_path:
+            self._image_cache = (image_cache_bytes, image_cache_resize)
+        else:
+            self._image_cache = None
+
     def _select(self, x, y, low_range, high_range):
         idxes = np.where(np.logical_and(y >= low_range, y < high_range))[0]
         return x[idxes], y[idxes]
 
-    def _select_rmm(self, x, y, low_range, high_range, m_rate):
+    def _select_rmm(self, indices, source, m_rate):
         assert m_rate is not None
-        if m_rate != 0:
-            idxes = np.where(np.logical_and(y >= low_range, y < high_range))[0]
-            selected_idxes = np.random.randint(
-                0, len(idxes), size=int((1 - m_rate) * len(idxes))
-            )
-            new_idxes = idxes[selected_idxes]
-            new_idxes = np.sort(new_idxes)
-        else:
-            new_idxes = np.where(np.logical_and(y >= low_range, y < high_range))[0]
-        return x[new_idxes], y[new_idxes]
+        positions = [np.array([], dtype=np.int64)]
+        for idx in indices:
+            idxes = self.get_positions([idx], source)
+            if m_rate != 0:
+                selected_idxes = np.random.randint(
+                    0, len(idxes), size=int((1 - m_rate) * len(idxes))
+                )
+                idxes = np.sort(idxes[selected_idxes])
+            positions.append(idxes)
+        return np.concatenate(positions)
 
     def getlen(self, index):
         y = self._train_targets
@@ -187,19 +365,35 @@ class DataManager(object):
 
 
 class DummyDataset(Dataset):
-    def __init__(self, images, labels, trsf, use_path=False):
+    def __init__(
+        self,
+        images,
+        labels,
+        trsf,
+        use_path=False,
+        loader=None,
+        image_cache=None,
+        cached=None,
+    ):
         assert len(images) == len(labels), "Data size error!"
         self.images = images
         self.labels = labels
         self.trsf = trsf
         self.use_path = use_path
+        self.loader = pil_loader if loader is None else loader
+        # (max_bytes, resize) of the image cache, and which images go through it
+        self.image_cache = image_cache
+        self.cached = cached
 
     def __len__(self):
         return len(self.images)
 
     def __getitem__(self, idx):
-        if self.use_path:
-            image = self.trsf(pil_loader(self.images[idx]))
+        if self.use_path and self.cached is not None and self.cached[idx]:
+            cache = get_image_cache(*self.image_cache)
+            image = self.trsf(cache.get(self.images[idx], self.loader))
+        elif self.use_path:
+            image = self.trsf(self.loader(self.images[idx]))
         else:
             image = self.trsf(Image.fromarray(self.images[idx]))
         label = self.labels[idx]
@@ -207,8 +401,61 @@ class DummyDataset(Dataset):
         return idx, image, label
 
 
+class TensorDummyDataset(Dataset):
+    """
+    In-memory uint8 dataset that augments a whole batch at once: DataLoader
+    hands __getitems__ the indices of a batch, which are transformed with
+    vectorized tensor ops instead of one PIL pipeline per sample. With
+    `device` set, the batch is augmented there when loading in the main process,
+    and with `resident` the uint8 images are kept there too.
+    """
+
+    def __init__(self, images, labels, trsf, device=None, resident=False):
+        assert len(images) == len(labels), "Data size error!"
+        self.images = torch.from_numpy(np.ascontiguousarray(images))
+        if resident and device is not None:
+            self.images = self.images.to(device)
+        self.labels = labels
+        self.trsf = trsf
+        self.device = device
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, indices):
+        images = self.get_batch(indices)
+        return [(idx, image, self.labels[idx]) for idx, image in zip(indices, images)]
+
+    def get_batch(self, indices):
+        """The augmented images of `indices`, as one tensor."""
+        images = self.images[indices]
+        if self.device is not None and get_worker_info() is None:
+            images = images.to(self.device, non_blocking=True)
+        return self.trsf(to_float_batch(images))
+
+
 def _map_new_class_index(y, order):
-    return np.array(list(map(lambda x: order.index(x), y)))
+    # Inverse permutation lookup instead of order.index() for every label
+    inverse = np.full(max(max(order), np.max(y)) + 1, -1, dtype=np.int64)
+    inverse[order] = np.arange(len(order))
+    y = inverse[y]
+    if (y < 0).any():
+        raise ValueError("Labels missing from the class order.")
+    return y
+
+
+def _build_class_index(y, nb_classes):
+    """
+    CSR-style table: the positions of class c are
+    positions[offsets[c] : offsets[c + 1]], in ascending order.
+    """
+    positions = np.argsort(y, kind="stable")
+    offsets = np.zeros(nb_classes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(y, minlength=nb_classes), out=offsets[1:])
+    return positions, offsets
 
 
 def _get_idata(dataset_name):
@@ -221,6 +468,10 @@ def _get_idata(dataset_name):
         return iImageNet1000()
     elif name == "imagenet100":
         return iImageNet100()
+    elif name == "imagenet1000_shard":
+        return iImageNet1000Shard()
+    elif name == "imagenet100_shard":
+        return iImageNet100Shard()
     else:
         raise NotImplementedError("Unknown dataset {}.".format(dataset_name))
 
@@ -0,0 +1,88 @@
+import numpy as np
+
+
+class ExemplarMemory(object):
+    """
+    Exemplar set stored as positions into the train split of a DataManager
+    instead of copies of the raw images (or paths).
+
+    Every class owns a contiguous segment of a preallocated buffer, so reducing
+    a class is O(1) and appending a class is amortized O(exemplars); the buffer
+    is only compacted when it runs out of room.
+    """
+
+    def __init__(self, capacity=0):
+        self._buffer = np.empty(capacity, dtype=np.int64)
+        self._end = 0
+        self._segments = {}  # class_idx -> (offset, count)
+        self._data_manager = None
+
+    def __len__(self):
+        return sum(count for _, count in self._segments.values())
+
+    @property
+    def classes(self):
+        return np.array(sorted(self._segments), dtype=np.int64)
+
+    @property
+    def positions(self):
+        """Train positions of all exemplars, grouped by class in ascending order."""
+        if len(self._segments) == 0:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(
+            [
+                self._buffer[offset : offset + count]
+                for offset, count in (self._segments[c] for c in self.classes)
+            ]
+        )
+
+    @property
+    def targets(self):
+        counts = [self._segments[c][1] for c in self.classes]
+        return np.repeat(self.classes, counts)
+
+    def get_memory(self):
+        """(data, targets) of the exemplars, gathered from the train split on demand."""
+        if len(self) == 0:
+            return None
+        return self._data_manager.get_data(self.positions, source="train")
+
+    def reduce(self, m):
+        for class_idx, (offset, count) in self._segments.items():
+            self._segments[class_idx] = (offset, min(count, m))
+
+    def remove(self, classes):
+        for class_idx in classes:
+            self._segments.pop(int(class_idx), None)
+
+    def extend(self, positions, targets, data_manager):
+        """Append exemplars given by train `positions`, grouped by their class."""
+        self._data_manager = data_manager
+        order = np.argsort(targets, kind="stable")
+        classes, starts = np.unique(targets[order], return_index=True)
+        for class_idx, class_positions in zip(
+            classes, np.split(positions[order], starts[1:])
+        ):
+            self._add(int(class_idx), class_positions)
+
+    def _add(self, class_idx, positions):
+        self._segments.pop(class_idx, None)
+        if self._end + len(positions) > len(self._buffer):
+            self._compact(len(positions))
+
+        self._buffer[self._end : self._end + len(positions)] = positions
+        self._segments[class_idx] = (self._end, len(positions))
+        self._end += len(positions)
+
+    def _compact(self, extra):
+        positions, classes = self.positions, self.classes
+        counts = [self._segments[c][1] for c in classes]
+        capacity = max(2 * len(self._buffer), len(positions) + extra)
+
+        self._buffer = np.empty(capacity, dtype=np.int64)
+        self._buffer[: len(positions)] = positions
+        offsets = np.cumsum([0] + counts[:-1])
+        self._segments = {
+            int(c): (int(offset), count) for c, offset, count in zip(classes, offsets, counts)
+        }
+        self._end = len(positions)
@@ -0,0 +1,43 @@
+import numpy as np
+
+
+class FeatureCache(object):
+    """
+    Features of dataset samples keyed by (source, dataset index), valid for one
+    version of the network. Call reset() whenever the network weights changed.
+    """
+
+    def __init__(self):
+        self._indices = {}  # source -> sorted dataset indices
+        self._vectors = {}  # source -> [len(indices), feature_dim]
+
+    def reset(self):
+        self._indices, self._vectors = {}, {}
+
+    def lookup(self, indices, source="train"):
+        """
+        Returns (vectors, hit) where vectors[hit] are the cached features of
+        indices[hit]; rows of vectors for missing indices are undefined.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) == 0 or len(self._indices.get(source, [])) == 0:
+            return None, np.zeros(len(indices), dtype=bool)
+
+        cached_indices, cached_vectors = self._indices[source], self._vectors[source]
+        pos = np.searchsorted(cached_indices, indices)
+        pos[pos == len(cached_indices)] = 0
+        hit = cached_indices[pos] == indices
+
+        return cached_vectors[pos], hit
+
+    def update(self, indices, vectors, source="train"):
+        indices, uniq = np.unique(np.asarray(indices, dtype=np.int64), return_index=True)
+        vectors = vectors[uniq]
+        if source in self._indices:
+            _, hit = self.lookup(indices, source)
+            indices = np.concatenate((self._indices[source], indices[~hit]))
+            vectors = np.concatenate((self._vectors[source], vectors[~hit]))
+            order = np.argsort(indices, kind="stable")
+            indices, vectors = indices[order], vectors[order]
+
+        self._indices[source], self._vectors[source] = indices, vectors
@@ -0,0 +1,118 @@
+import numpy as np
+import torch
+
+# Upper bound on the number of float entries of a padded [classes, n, feature_dim]
+# block, so that batching many ImageNet classes does not blow up host memory.
+max_block_elements = 2 ** 26
+
+
+def herding(vectors, m):
+    """
+    vectors: [n, feature_dim] L2-normalized features of one class.
+    Returns the indices of the selected exemplars in selection order.
+    """
+    return herding_batch([vectors], [m])[0]
+
+
+def herding_batch(class_vectors, ms, device=None):
+    """
+    class_vectors: list of [n_c, feature_dim] L2-normalized features, one per class.
+    ms: number of exemplars per class (int or list of ints).
+
+    Greedy herding for every class at once. Instead of deleting the picked rows
+    after each step, a running sum of the selected vectors and a "taken" mask are
+    kept, which selects exactly the same indices as the per-class reference loop.
+    If `device` is given, the selection runs in torch on that device instead
+    (same algorithm, float32 reductions may break near-ties differently).
+    """
+    nb_classes = len(class_vectors)
+    if isinstance(ms, int):
+        ms = [ms] * nb_classes
+    ms = [min(m, len(v)) for m, v in zip(ms, class_vectors)]
+
+    selected = [None] * nb_classes
+    start = 0
+    while start < nb_classes:
+        end, n_max = start, 0
+        while end < nb_classes:
+            _n_max = max(n_max, len(class_vectors[end]))
+            if end > start and (end + 1 - start) * _n_max * class_vectors[end].shape[
+                1
+            ] > max_block_elements:
+                break
+            n_max = _n_max
+            end += 1
+
+        if device is None:
+            block = _herding_block_numpy(class_vectors[start:end], ms[start:end], n_max)
+        else:
+            block = _herding_block_torch(
+                class_vectors[start:end], ms[start:end], n_max, device
+            )
+        selected[start:end] = block
+        start = end
+
+    return selected
+
+
+def _pad(class_vectors, n_max):
+    nb_classes, feature_dim = len(class_vectors), class_vectors[0].shape[1]
+    dtype = np.result_type(*[v.dtype for v in class_vectors])
+    vectors = np.zeros((nb_classes, n_max, feature_dim), dtype=dtype)
+    taken = np.ones((nb_classes, n_max), dtype=bool)
+    for c, v in enumerate(class_vectors):
+        vectors[c, : len(v)] = v
+        taken[c, : len(v)] = False  # Padding rows are never selectable
+
+    return vectors, taken
+
+
+def _herding_block_numpy(class_vectors, ms, n_max):
+    vectors, taken = _pad(class_vectors, n_max)
+    class_means = np.stack([np.mean(v, axis=0) for v in class_vectors])[:, None, :]
+    S = np.zeros_like(class_means)  # [nb_classes, 1, feature_dim] running sum
+    rows = np.arange(len(class_vectors))
+    selected = np.zeros((len(class_vectors), max(ms, default=0)), dtype=np.int64)
+
+    for k in range(1, max(ms, default=0) + 1):
+        mu_p = (vectors + S) / k  # [nb_classes, n, feature_dim]
+        dists = np.sqrt(np.sum((class_means - mu_p) ** 2, axis=2))
+        dists[taken] = np.inf
+        i = np.argmin(dists, axis=1)
+
+        active = np.array([k <= m for m in ms])
+        i[~active] = 0
+        selected[:, k - 1] = i
+        taken[rows[active], i[active]] = True
+        S[active, 0] += vectors[rows[active], i[active]]
+
+    return [selected[c, :m] for c, m in enumerate(ms)]
+
+
+def _herding_block_torch(class_vectors, ms, n_max, device):
+    vectors, taken = _pad(class_vectors, n_max)
+    vectors = torch.from_numpy(vectors).float().to(device)
+    taken = torch.from_numpy(taken).to(device)
+    lengths = torch.tensor([len(v) for v in class_vectors], device=device)
+    class_means = (vectors.sum(dim=1) / lengths[:, None]).unsqueeze(1)
+    S = torch.zeros_like(class_means)
+    rows = torch.arange(len(class_vectors), device=device)
+    budget = torch.tensor(ms, device=device)
+    selected = torch.zeros(
+        (len(class_vectors), max(ms, default=0)), dtype=torch.long, device=device
+    )
+
+    for k in range(1, max(ms, default=0) + 1):
+        mu_p = (vectors + S) / k
+        dists = torch.sum((class_means - mu_p) ** 2, dim=2)
+        dists.masked_fill_(taken, float("inf"))
+        i = torch.argmin(dists, dim=1)
+
+        active = budget >= k
+        i = torch.where(active, i, torch.zeros_like(i))
+        selected[:, k - 1] = i
+        taken[rows[active], i[active]] = True
+        S[active, 0] += vectors[rows[active], i[active]]
+
+    selected = selected.cpu().numpy()
+    return [selected[c, :m] for c, m in enumerate(ms)]
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from torchvision.transforms import functional as TF
+
+_caches = {}  # (max_bytes, resize) -> DecodedImageCache of this process
+
+
+def get_image_cache(max_bytes, resize=None):
+    """
+    The process-wide cache for these settings. Datasets only carry the settings,
+    so a persistent DataLoader worker keeps its cache across epochs and tasks
+    even though the dataset it serves is re-created for every task.
+    """
+    if (max_bytes, resize) not in _caches:
+        _caches[(max_bytes, resize)] = DecodedImageCache(max_bytes, resize)
+    return _caches[(max_bytes, resize)]
+
+
+class DecodedImageCache(object):
+    """
+    LRU cache of decoded images as uint8 arrays, bounded by their total size in
+    bytes. With `resize` set, images are stored with their short side resized
+    to it (like transforms.Resize(resize)) to fit more of them.
+    """
+
+    def __init__(self, max_bytes, resize=None):
+        self.max_bytes = max_bytes
+        self.resize = resize
+        self._images = OrderedDict()
+        self._nbytes = 0
+
+    def __len__(self):
+        return len(self._images)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get(self, key, loader):
+        image = self._images.get(key)
+        if image is None:
+            img = loader(key)
+            if self.resize is not None:
+                img = TF.resize(img, self.resize)
+            image = np.asarray(img)
+            self._put(key, image)
+        else:
+            self._images.move_to_end(key)
+
+        return Image.fromarray(image)
+
+    def _put(self, key, image):
+        if image.nbytes > self.max_bytes:
+            return
+        self._images[key] = image
+        self._nbytes += image.nbytes
+        while self._nbytes > self.max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self._nbytes -= evicted.nbytes
@@ -0,0 +1,187 @@
+import os
+import pickle
+import shutil
+import tempfile
+import weakref
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+
+class LoaderFactory(object):
+    """
+    Hands out one DataLoader per named slot ("train", "test", ...) and keeps it
+    alive across epochs and tasks. Asking a slot for a new dataset swaps it into
+    the existing loader instead of building a new one, so its persistent worker
+    processes are reused for the whole run.
+
+    Reads "persistent_workers" (default True), "pin_memory" (default False) and
+    "prefetch_factor" (default: DataLoader's) from args.
+    """
+
+    def __init__(self, args):
+        self.persistent_workers = args.get("persistent_workers", True)
+        self.pin_memory = args.get("pin_memory", False)
+        self.prefetch_factor = args.get("prefetch_factor", None)
+        self._slots = {}  # name -> (loader config, loader)
+        self._dir = None
+
+    def get_loader(
+        self,
+        name,
+        dataset,
+        batch_size,
+        shuffle=False,
+        num_workers=0,
+        pin_memory=None,
+        sampler=None,
+    ):
+        """`sampler`: optional sampler of dataset keys, overrides the order of `shuffle`."""
+        pin_memory = self.pin_memory if pin_memory is None else pin_memory
+        if getattr(dataset, "device", None) is not None:
+            # Tensor-resident batches are augmented on the device, i.e. in this
+            # process, and device tensors cannot be pinned
+            num_workers = 0
+            pin_memory = False
+        if getattr(dataset, "preloaded", False):
+            if not shuffle:
+                return dataset.get_loader(batch_size)
+            num_workers = 0
+        if num_workers == 0 or not self.persistent_workers:
+            return DataLoader(
+                dataset,
+                batch_size=batch_size,
+                shuffle=shuffle and sampler is None,
+                sampler=sampler,
+                num_workers=num_workers,
+                pin_memory=pin_memory,
+                prefetch_factor=self.prefetch_factor if num_workers > 0 else None,
+            )
+
+        config = (batch_size, shuffle, num_workers, pin_memory)
+        if name in self._slots and self._slots[name][0] == config:
+            loader = self._slots[name][1]
+            workers_alive = getattr(loader, "_iterator", None) is not None
+            loader.dataset.swap(dataset, workers_alive)
+            loader.sampler.sampler = sampler
+            return loader
+
+        swappable = SwappableDataset(dataset, os.path.join(self._get_dir(), name))
+        loader = SlotLoader(
+            swappable,
+            batch_size=batch_size,
+            sampler=GenerationSampler(swappable, shuffle, sampler),
+            num_workers=num_workers,
+            persistent_workers=True,
+            pin_memory=pin_memory,
+            prefetch_factor=self.prefetch_factor,
+        )
+        self._slots[name] = (config, loader)
+        return loader
+
+    def _get_dir(self):
+        if self._dir is None:
+            shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            self._dir = tempfile.mkdtemp(prefix="cil-loaders-", dir=shm)
+            weakref.finalize(self, shutil.rmtree, self._dir, True)
+        return self._dir
+
+
+class SlotLoader(DataLoader):
+    """
+    DataLoader of a SwappableDataset. Once the first batch of an epoch is in,
+    the workers have drained every index of the previous epochs, so the files
+    of the datasets swapped out before it can go.
+    """
+
+    def __iter__(self):
+        for i, batch in enumerate(super().__iter__()):
+            if i == 0:
+                self.dataset.release()
+            yield batch
+
+
+class SwappableDataset(Dataset):
+    """
+    Wraps the current dataset of a slot. Indices come from GenerationSampler as
+    (generation, idx); a worker that sees a newer generation than the one it
+    holds loads the swapped-in dataset from the file written by swap().
+    """
+
+    def __init__(self, dataset, path):
+        self.dataset = dataset
+        self.generation = 0
+        self._path = path + "-{}.pkl"
+        self._stale = []
+
+    def swap(self, dataset, workers_alive):
+        # Indices of an abandoned epoch can still refer to the old dataset until
+        # the workers are reset, see SlotLoader
+        self._stale.append(self._path.format(self.generation))
+        self.dataset = dataset
+        self.generation += 1
+        if workers_alive:
+            with open(self._path.format(self.generation), "wb") as f:
+                pickle.dump(dataset, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def release(self):
+        """Removes the files of the generations before the current one."""
+        for path in self._stale:
+            if os.path.exists(path):
+                os.remove(path)
+        self._stale = []
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        generation, idx = index
+        self._sync(generation)
+        return self.dataset[idx]
+
+    def __getitems__(self, indices):
+        self._sync(indices[0][0])
+        indices = [idx for _, idx in indices]
+        if hasattr(self.dataset, "__getitems__"):
+            return self.dataset.__getitems__(indices)
+        return [self.dataset[idx] for idx in indices]
+
+    def _sync(self, generation):
+        if generation != self.generation:
+            path = self._path.format(generation)
+            if not os.path.exists(path):
+                raise RuntimeError(
+                    "Dataset generation {} of {} was released while a worker "
+                    "still had indices of it.".format(generation, path)
+                )
+            with open(path, "rb") as f:
+                self.dataset = pickle.load(f)
+            self.generation = generation
+
+
+class GenerationSampler(Sampler):
+    """
+    Same order as the default Sequential/RandomSampler, or as `sampler` if set,
+    tagged with the dataset generation.
+    """
+
+    def __init__(self, dataset, shuffle, sampler=None):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.sampler = sampler
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        n, generation = len(self.dataset), self.dataset.generation
+        if self.sampler is not None:
+            order = self.sampler
+        elif self.shuffle:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+            order = torch.randperm(n, generator=generator).tolist()
+        else:
+            order = range(n)
+        for idx in order:
+            yield generation, idx
@@ -0,0 +1,100 @@
+"""
+Pre-decoded image shards: every image is resized once (short side to
+`short_side`) and stored as raw uint8 HWC pixels in one flat `<prefix>.bin`
+file, with `<prefix>.npz` holding the byte offsets, shapes, targets and the
+records of each split. Training then reads zero-copy slices of a memory map
+instead of opening and decoding a JPEG for every sample of every epoch.
+"""
+import os
+import numpy as np
+from multiprocessing import Pool
+from PIL import Image
+
+
+def write_shard(splits, prefix, short_side=256, num_workers=8):
+    """
+    splits: {split_name: list of (path, target)}, e.g. ImageFolder(...).imgs.
+    Writes <prefix>.bin and <prefix>.npz.
+    """
+    names = list(splits)
+    paths = [path for name in names for path, _ in splits[name]]
+    targets = np.array(
+        [target for name in names for _, target in splits[name]], dtype=np.int64
+    )
+    sizes = np.cumsum([0] + [len(splits[name]) for name in names])
+    offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    shapes = np.zeros((len(paths), 2), dtype=np.int32)
+
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+    with open(prefix + ".bin", "wb") as f, Pool(num_workers) as pool:
+        images = pool.imap(_decode, [(path, short_side) for path in paths], 64)
+        for i, image in enumerate(images):
+            f.write(image.tobytes())
+            shapes[i] = image.shape[:2]
+            offsets[i + 1] = offsets[i] + image.size
+
+    np.savez(
+        prefix + ".npz",
+        offsets=offsets,
+        shapes=shapes,
+        targets=targets,
+        **{
+            "split_" + name: np.arange(start, end)
+            for name, start, end in zip(names, sizes[:-1], sizes[1:])
+        }
+    )
+
+
+def load_shard(prefix):
+    """
+    Returns (loader, {split_name: (records, targets)}), where records are the
+    keys `loader` maps to images.
+    """
+    index = np.load(prefix + ".npz")
+    targets = index["targets"]
+    splits = {
+        key[len("split_") :]: (index[key], targets[index[key]])
+        for key in index.files
+        if key.startswith("split_")
+    }
+    return ShardLoader(prefix), splits
+
+
+class ShardLoader(object):
+    """
+    Maps a record index to a PIL image. The memory map is opened lazily, and
+    dropped when pickled, so every DataLoader worker maps the file itself.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        index = np.load(prefix + ".npz")
+        self.offsets, self.shapes = index["offsets"], index["shapes"]
+        self._data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def __call__(self, record):
+        if self._data is None:
+            self._data = np.memmap(self.prefix + ".bin", dtype=np.uint8, mode="r")
+        h, w = self.shapes[record]
+        start = self.offsets[record]
+        return Image.fromarray(self._data[start : start + h * w * 3].reshape(h, w, 3))
+
+
+def _decode(item):
+    path, short_side = item
+    with open(path, "rb") as f:
+        img = Image.open(f).convert("RGB")
+    w, h = img.size
+    if short_side is not None and min(w, h) != short_side:
+        # Same output size as transforms.Resize(short_side)
+        if w < h:
+            size = (short_side, int(short_side * h / w))
+        else:
+            size = (int(short_side * w / h), short_side)
+        img = img.resize(size, Image.BILINEAR)
+    return np.asarray(img, dtype=np.uint8)
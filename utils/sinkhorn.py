@@ -0,0 +1,53 @@
+import torch
+
+# Same defaults as ot.sinkhorn
+max_iter = 1000
+tol = 1e-9
+check_every = 10
+
+
+def sinkhorn(a, b, M, reg, init=None, max_iter=max_iter, tol=tol):
+    """
+    Entropic OT plan between the histograms a [n] and b [m] for the cost M
+    [n, m], solved in the log domain on the device of M.
+
+    Runs the iterations of ot.sinkhorn (column then row scaling), so both give
+    the same plan up to float rounding, without the under/overflow of the
+    scalings for a small reg or for histograms of different masses. Every
+    check_every iterations it stops when the column marginals are within tol
+    of b, or when they no longer move. They never reach b when a and b have
+    different masses, as in COIL.
+
+    init: the potentials of an earlier call on a problem of the same shape,
+    e.g. the same classes with refreshed means, to warm-start from its plan.
+    Returns the plan and its (log-)potentials (u, v).
+    """
+    a, b = a.to(M), b.to(M)
+    log_a, log_b = a.log(), b.log()
+    scaled_M = M / reg
+    if init is not None and init[0].shape == a.shape:
+        u = init[0].to(M)
+    else:
+        u = torch.zeros_like(a)
+
+    marginal = None
+    for it in range(max_iter):
+        v = log_b - torch.logsumexp(u.unsqueeze(1) - scaled_M, dim=0)
+        u = log_a - torch.logsumexp(v.unsqueeze(0) - scaled_M, dim=1)
+        if it % check_every == 0:
+            prev_marginal = marginal
+            marginal = _plan(u, v, scaled_M).sum(dim=0)
+            if torch.norm(marginal - b) < tol:
+                break
+            if prev_marginal is not None and torch.norm(marginal - prev_marginal) < tol:
+                break
+            # With different masses the potentials drift by log(mass ratio) per
+            # iteration; shifting both by the same constant keeps the plan
+            shift = u.max()
+            u, v = u - shift, v + shift
+
+    return _plan(u, v, scaled_M), (u, v)
+
+
+def _plan(u, v, scaled_M):
+    return torch.exp(u.unsqueeze(1) + v.unsqueeze(0) - scaled_M)
@@ -0,0 +1,159 @@
+import logging
+import os
+import shutil
+import tempfile
+import weakref
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+
+
+class TeacherCache(object):
+    """
+    Outputs of a frozen teacher network, stored per key as float16 in
+    memory-mapped files and filled in as keys are first seen. A key is a
+    sample and one of its fixed augmentations, see ReplaySampler.
+
+    Fields are tensors ("logits", "features") or lists of tensors ("fmaps"),
+    batch first. The teacher must be in eval mode, so that the outputs of a
+    sample do not depend on the rest of its batch. The buffers are sized from
+    the first outputs, and refused if they would exceed `max_bytes`.
+    """
+
+    def __init__(self, nb_keys, fields=("logits",), directory=None, max_bytes=None):
+        self.nb_keys = nb_keys
+        self.fields = fields
+        self.max_bytes = max_bytes
+        self._filled = np.zeros(nb_keys, dtype=bool)
+        self._buffers = None  # field -> memmap, or list of memmaps
+        self._dir = tempfile.mkdtemp(prefix="cil-teacher-", dir=directory)
+        weakref.finalize(self, shutil.rmtree, self._dir, True)
+
+    def __call__(self, keys, inputs, forward):
+        """
+        The fields of forward(inputs) for the batch `keys`, only running forward
+        on the inputs whose keys are not cached yet. Every output goes through
+        float16, whether it was cached or not.
+        """
+        keys = keys.numpy()
+        missing = ~self._filled[keys]
+        if missing.any():
+            with torch.no_grad():
+                outputs = forward(inputs[torch.from_numpy(missing).to(inputs.device)])
+            self._write(keys[missing], outputs)
+            self._filled[keys[missing]] = True
+
+        return {
+            field: _read(self._buffers[field], keys, inputs.device)
+            for field in self.fields
+        }
+
+    def _write(self, keys, outputs):
+        if self._buffers is None:
+            self._check_size(outputs)
+            self._buffers = {}
+            for field in self.fields:
+                if isinstance(outputs[field], (list, tuple)):
+                    self._buffers[field] = [
+                        self._allocate("{}_{}".format(field, i), output)
+                        for i, output in enumerate(outputs[field])
+                    ]
+                else:
+                    self._buffers[field] = self._allocate(field, outputs[field])
+        for field in self.fields:
+            _write(self._buffers[field], keys, outputs[field])
+
+    def _check_size(self, outputs):
+        shapes = []
+        for field in self.fields:
+            output = outputs[field]
+            for out in output if isinstance(output, (list, tuple)) else [output]:
+                shapes.append(out.shape[1:])
+        nbytes = self.nb_keys * sum(2 * int(np.prod(shape)) for shape in shapes)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            raise ValueError(
+                "The teacher cache of {} ({} keys) needs {:.1f} GiB, more than "
+                "teacher_cache_bytes ({:.1f} GiB). Lower aug_replays or raise "
+                "teacher_cache_bytes.".format(
+                    ", ".join(self.fields),
+                    self.nb_keys,
+                    nbytes / 2 ** 30,
+                    self.max_bytes / 2 ** 30,
+                )
+            )
+        logging.info(
+            "Teacher cache: {:.1f} GiB in {}".format(nbytes / 2 ** 30, self._dir)
+        )
+
+    def _allocate(self, name, output):
+        return np.lib.format.open_memmap(
+            os.path.join(self._dir, "{}.npy".format(name)),
+            mode="w+",
+            dtype=np.float16,
+            shape=(self.nb_keys, *output.shape[1:]),
+        )
+
+
+class ReplaySampler(Sampler):
+    """
+    Shuffles the samples like a RandomSampler, but yields keys
+    idx * nb_replays + variant, where the augmentation variant cycles with the
+    epoch: every sample is only ever seen under nb_replays augmentations.
+    """
+
+    def __init__(self, nb_samples, nb_replays):
+        self.nb_samples = nb_samples
+        self.nb_replays = nb_replays
+        self.epoch = 0
+
+    def __len__(self):
+        return self.nb_samples
+
+    def __iter__(self):
+        variant = self.epoch % self.nb_replays
+        self.epoch += 1
+        seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        order = torch.randperm(self.nb_samples, generator=generator)
+        return iter((order * self.nb_replays + variant).tolist())
+
+
+class ReplayDataset(Dataset):
+    """
+    Wraps a dataset for keys of ReplaySampler: the sample of a key is
+    transformed with the torch RNG seeded from the key, so the same key always
+    gets the same augmentation. Returns the key in place of the index.
+    """
+
+    def __init__(self, dataset, nb_replays, seed):
+        self.dataset = dataset
+        self.nb_replays = nb_replays
+        self.seed = seed
+
+    @property
+    def device(self):
+        return getattr(self.dataset, "device", None)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, key):
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self.seed + key)
+            _, image, label = self.dataset[key // self.nb_replays]
+        return key, image, label
+
+
+def _write(buffer, keys, output):
+    if isinstance(buffer, list):
+        for buf, out in zip(buffer, output):
+            _write(buf, keys, out)
+    else:
+        buffer[keys] = output.detach().to(torch.float16).cpu().numpy()
+
+
+def _read(buffer, keys, device):
+    if isinstance(buffer, list):
+        return [_read(buf, keys, device) for buf in buffer]
+    return torch.from_numpy(buffer[keys]).to(device).float()
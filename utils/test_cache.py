@@ -0,0 +1,123 @@
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torchvision import transforms
+from utils.augment import BatchCompose, BatchNormalize, to_float_batch
+
+
+class TestTensorCache(object):
+    """
+    Test images of the classes seen so far, after the deterministic test
+    transform, appended class by class into one growing buffer.
+
+    When the common transform is ToTensor (+ Normalize), the images are kept as
+    uint8 [n, h, w, c] after the PIL-level test transform, and converted and
+    normalized per batch when read, which is 4x smaller than float tensors.
+    Otherwise the fully transformed float tensors are kept.
+    """
+
+    def __init__(self, test_trsf, common_trsf):
+        self.normalize = _batch_normalize(common_trsf)
+        if self.normalize is not None:
+            self.trsf = transforms.Compose(test_trsf)
+        else:
+            self.trsf = transforms.Compose([*test_trsf, *common_trsf])
+        self._images = None
+        self._end = 0
+        self._slices = {}  # class_idx -> (start, end) in self._images
+
+    def __contains__(self, class_idx):
+        return class_idx in self._slices
+
+    def append(self, class_idx, images):
+        """images: PIL images of one class, in position order."""
+        if self.normalize is not None:
+            images = np.stack([np.asarray(self.trsf(img)) for img in images])
+            images = torch.from_numpy(images)
+        else:
+            images = torch.stack([self.trsf(img) for img in images])
+
+        if self._images is None:
+            self._images = images.new_empty((8 * max(len(images), 1), *images.shape[1:]))
+        if self._end + len(images) > len(self._images):
+            capacity = max(2 * len(self._images), self._end + len(images))
+            grown = self._images.new_empty((capacity, *self._images.shape[1:]))
+            grown[: self._end] = self._images[: self._end]
+            self._images = grown
+
+        self._images[self._end : self._end + len(images)] = images
+        self._slices[class_idx] = (self._end, self._end + len(images))
+        self._end += len(images)
+
+    def get(self, indices):
+        """Stored images of the classes `indices`, a view when they are contiguous."""
+        slices = [self._slices[idx] for idx in indices]
+        if len(slices) == 0:
+            return self._images[:0]
+        if all(prev[1] == cur[0] for prev, cur in zip(slices[:-1], slices[1:])):
+            return self._images[slices[0][0] : slices[-1][1]]
+        return torch.cat([self._images[start:end] for start, end in slices])
+
+
+class PreloadedDataset(Dataset):
+    """Already decoded test samples, yielding the same (idx, image, label) as DummyDataset."""
+
+    # Nothing left to decode, worker processes would only add copies
+    preloaded = True
+
+    def __init__(self, images, labels, normalize=None):
+        assert len(images) == len(labels), "Data size error!"
+        self.images = images
+        self.labels = labels
+        self.normalize = normalize
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        return idx, self._finalize(self.images[idx : idx + 1])[0], self.labels[idx]
+
+    def get_loader(self, batch_size):
+        return PreloadedLoader(self, batch_size)
+
+    def _finalize(self, images):
+        if self.normalize is None:
+            return images
+        return self.normalize(to_float_batch(images))
+
+
+class PreloadedLoader(object):
+    """In-order batches of a PreloadedDataset, sliced and normalized without a DataLoader."""
+
+    def __init__(self, dataset, batch_size):
+        self.dataset = dataset
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        # A DataLoader draws its base seed here; do the same so that the torch
+        # RNG stream, and thus training, does not depend on the cache
+        torch.empty((), dtype=torch.int64).random_()
+        labels = torch.as_tensor(self.dataset.labels)
+        for start in range(0, len(self.dataset), self.batch_size):
+            end = min(start + self.batch_size, len(self.dataset))
+            yield (
+                torch.arange(start, end),
+                self.dataset._finalize(self.dataset.images[start:end]),
+                labels[start:end],
+            )
+
+
+def _batch_normalize(common_trsf):
+    """Batched equivalent of common_trsf if it is ToTensor (+ Normalize), else None."""
+    if len(common_trsf) == 0 or not isinstance(common_trsf[0], transforms.ToTensor):
+        return None
+    batch_trsf = []
+    for t in common_trsf[1:]:
+        if not isinstance(t, transforms.Normalize):
+            return None
+        batch_trsf.append(BatchNormalize(t.mean, t.std))
+
+    return BatchCompose(batch_trsf)